@@ -11,8 +11,18 @@ import time
 import numpy as np
 from PIL import Image, PngImagePlugin
 import re
+import logging
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from parameters import parameters  # Import the parameters dictionary
+from shared_functions import uint16_array_to_image, average_uint16_images, load_processed_minutes, save_processed_minutes
+
+# Debugging statements go through logging, so they cost nothing unless the level is set to logging.DEBUG below.
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+# Metadata copied from the first captured spectrogram into the averaged image. Date/Time and Temperature change every minute, so they are read per minute.
+averaged_metadata_keys = ("Exposure Time", "Date/Time", "Temperature", "Binning", "Note")
 
 # Function to extract the device name (MISS1 or MISS2) from the metadata. If no metadata present, "MISS2" is returned by default.
 def get_device_name_from_metadata(filepath):
@@ -29,6 +39,27 @@ def get_device_name_from_metadata(filepath):
         print(f"Error reading metadata from {os.path.basename(filepath)}: {e}")
         return "MISS2"  #Default to "MISS2" in case of error, , change to MISS1 on MISS1 computer.
         
+# Function to split a spectrogram filename (MISS2-YYYYMMDD-HHMMSS.png) into its date and time parts by slicing, returns None if the filename does not match.
+def split_spectrogram_filename(filename, prefix="MISS2-"): # Change MISS2 to MISS1 on MISS1 computer.
+    if len(filename) != 25 or not filename.startswith(prefix) or not filename.endswith('.png') or filename[14] != '-':
+        return None
+    date_part, time_part = filename[6:14], filename[15:21]
+    if not (date_part.isdigit() and time_part.isdigit()):
+        return None
+    return date_part, time_part
+
+# Function to load a spectrogram as a uint16 array together with its metadata. Returns None if the image could not be read.
+def load_spectrogram(filepath):
+    try:
+        log.debug("Opening image: %s", filepath)  # DEBUGGING
+        with Image.open(filepath) as img:
+            img_array = np.asarray(img, dtype=np.uint16)
+            log.debug("Image shape: %s", img_array.shape)  # CHECKING image array shape
+            return img_array, img.info
+    except Exception as e:
+        print(f"Error processing image {os.path.basename(filepath)}: {e}")
+        return None
+
 #Function to average the captured spectrograms of the last 5minutes. They are averaged minute wise.
 def average_images(PNG_base_folder, raw_PNG_folder, processed_minutes):
     # Use the current date and time in UTC
@@ -39,68 +70,59 @@ def average_images(PNG_base_folder, raw_PNG_folder, processed_minutes):
     time_5_minutes_ago = current_time - datetime.timedelta(minutes=5)
     
     images_by_minute = defaultdict(list)
-    filename_regex = re.compile(r'^MISS2-(\d{8})-(\d{6})\.png$')  # Regex for the PNG file pattern, change MISS2 to MISS1 on MISS1 computer
     current_date_str = current_time.strftime("%Y%m%d")
+
+    # Time window as YYYYMMDD-HHMMSS strings, fixed width timestamps compare in the same order as the times themselves.
+    window_start_str = time_5_minutes_ago.strftime("%Y%m%d-%H%M%S")
+    window_end_str = current_time.strftime("%Y%m%d-%H%M%S")
     
     # Set the folder for the current day
     raw_PNG_folder_today = os.path.join(raw_PNG_folder, current_date_str[:4], current_date_str[4:6], current_date_str[6:])
 
-    # Walk through the raw PNG folder of the current day
-    for root, dirs, files in os.walk(raw_PNG_folder_today):
-        print(f"Checking directory: {root}")  # DEBUG STATEMENT
-        for filename in files:
-            print(f"Found file: {filename}")  # DEBUG STATEMENT
-            filepath = os.path.join(root, filename)
-            match = filename_regex.match(filename)
-            if match:
-                date_part, time_part = match.groups()
-                image_time = datetime.datetime.strptime(f"{date_part}-{time_part}", "%Y%m%d-%H%M%S").replace(tzinfo=datetime.timezone.utc)
+    if not os.path.isdir(raw_PNG_folder_today):
+        print(f"No captured spectrograms found for today in {raw_PNG_folder_today}")
+        return
+
+    # Scan the raw PNG folder of the current day
+    log.debug("Checking directory: %s", raw_PNG_folder_today)  # DEBUG STATEMENT
+    with os.scandir(raw_PNG_folder_today) as entries:
+        for entry in entries:
+            log.debug("Found file: %s", entry.name)  # DEBUG STATEMENT
+            filename_parts = split_spectrogram_filename(entry.name)
+            if filename_parts:
+                date_part, time_part = filename_parts
 
                 # Only process images from the last 5 minutes
-                if time_5_minutes_ago <= image_time <= current_time:
+                if window_start_str <= f"{date_part}-{time_part}" <= window_end_str:
                     minute_key = date_part + '-' + time_part[:4]  # Group by minute
-                    print(f"Adding file to minute key: {minute_key}")  # DEBUG statement
-                    images_by_minute[minute_key].append(filepath)
+                    log.debug("Adding file to minute key: %s", minute_key)  # DEBUG statement
+                    images_by_minute[minute_key].append(entry.path)
 
 
     # Process each minute-group of images IF not already processed
     for minute_key, filepaths in images_by_minute.items():
         if len(filepaths) > 0:  # Only process if there are images
-            print(f"Processing minute: {minute_key}, with {len(filepaths)} images")  # DEBUGGING
+            log.debug("Processing minute: %s, with %s images", minute_key, len(filepaths))  # DEBUGGING
             if minute_key not in processed_minutes:
                 year, month, day, hour, minute = map(int, [minute_key[:4], minute_key[4:6], minute_key[6:8], minute_key[9:11], minute_key[11:]])
                 target_utc = datetime.datetime(year, month, day, hour, minute, tzinfo=datetime.timezone.utc)
 
-                sum_img_array = None
-                count = 0
                 device_name = "MISS2"  #Change this to MISS1 on MISS1 computer.
-                metadata = None  # Variable to hold metadata
-
-                # Process each image.
-                for filepath in filepaths:
-                    try:
-                        print(f"Opening image: {filepath}")  # DEBUGGING
-                        img = Image.open(filepath)
-                        img_array = np.array(img)
-                        print(f"Image shape: {img_array.shape}")  # CHECKING image array shape
-                        
-                        if sum_img_array is None:
-                            sum_img_array = np.zeros_like(img_array, dtype='float64')
 
-                        sum_img_array += img_array
-                        count += 1
+                # Decode the image(s) concurrently, PIL releases the GIL while decompressing. They are summed in one go below.
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    loaded_images = [result for result in executor.map(load_spectrogram, filepaths) if result is not None]
+                img_arrays = [img_array for img_array, _ in loaded_images]
 
-                        # Get metadata from the first image only.
-                        if metadata is None:
-                            metadata = img.info
+                # Get metadata from the first image only.
+                metadata = loaded_images[0][1] if loaded_images else None
 
-                    except Exception as e:
-                        print(f"Error processing image {os.path.basename(filepath)}: {e}")
+                count = len(img_arrays)
 
                 # Average the images and save if count >0
                 if count > 0:
-                    print(f"Count of images for averaging: {count}")  # DEBUGGING
-                    averaged_image = (sum_img_array / count).astype(np.uint16)
+                    log.debug("Count of images for averaging: %s", count)  # DEBUGGING
+                    averaged_image = average_uint16_images(img_arrays)
                     
                     # Create a shared directory for averaged PNGs
                     averaged_PNG_folder = os.path.join(PNG_base_folder)
@@ -112,38 +134,50 @@ def average_images(PNG_base_folder, raw_PNG_folder, processed_minutes):
 
                     # Save the averaged image
                     averaged_image_path = os.path.join(save_folder, f"{device_name}-{year:04d}{month:02d}{day:02d}-{hour:02d}{minute:02d}00.png")
-                    print(f"Saving averaged image to: {averaged_image_path}")  # DEBUGGING
+                    log.debug("Saving averaged image to: %s", averaged_image_path)  # DEBUGGING
                     
                     # Convert numpy array back to an Image object and specify the mode for 16-bit
-                    averaged_img = Image.fromarray(averaged_image, mode='I;16')
+                    averaged_img = uint16_array_to_image(averaged_image)
 
                     pnginfo = PngImagePlugin.PngInfo()
                     if metadata:
-                        for key, value in metadata.items():
-                            if key in ["Exposure Time", "Date/Time", "Temperature", "Binning", "Note"]:
-                                pnginfo.add_text(key, str(value))
+                        for key in averaged_metadata_keys:
+                            if key in metadata:
+                                pnginfo.add_text(key, str(metadata[key]))
                         pnginfo.add_text("Note", f"1-minute average image. {metadata.get('Note', '')}")
                     else:
                         pnginfo.add_text("Note", "1-minute average image.")
 
                     try:
-                        averaged_img.save(averaged_image_path, pnginfo=pnginfo)
+                        averaged_img.save(averaged_image_path, pnginfo=pnginfo, compress_level=1) # Fast zlib level, files are only slightly larger than with the default level 6.
                         print(f"Saved averaged image with metadata: {averaged_image_path}")  # DEBUGGING
                     except Exception as e:
                         print(f"Error saving averaged image: {e}")
 
-                    processed_minutes.append(minute_key)  # Keep track of processed minute keys
+                    # Keep track of processed minute keys. Only minutes that are over (including the last exposure) are kept, a minute still being captured is averaged again next time.
+                    if target_utc + datetime.timedelta(minutes=1, seconds=parameters['exposure_duration']) <= current_time:
+                        processed_minutes.add(minute_key)
                 else:
-                    print(f"No images processed for minute: {minute_key}")  # DEBUGGING
+                    log.debug("No images processed for minute: %s", minute_key)  # DEBUGGING
         else:
-            print(f"Skipping processing for minute: {minute_key}, with 0 images")  # DEBUGGING
+            log.debug("Skipping processing for minute: %s, with 0 images", minute_key)  # DEBUGGING
 
 # Use the parameters dictionary to get paths
 raw_PNG_folder = parameters['raw_PNG_folder']
 PNG_base_folder = parameters['averaged_PNG_folder']
 
-# List to keep track of processed minutes 
-processed_minutes = []
+# Keep running and average the last 5 minutes every 300 seconds, instead of being restarted for every run.
+while True:
+    start_time = time.time()
+
+    # Set to keep track of processed minutes, stored next to today's averaged images so reruns skip them.
+    today_str = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%d")
+    processed_minutes_path = os.path.join(PNG_base_folder, today_str[:4], today_str[4:6], today_str[6:], "processed_minutes.json")
+    processed_minutes = load_processed_minutes(processed_minutes_path)
+
+    # Call the average_images function for the current date and last 5 minutes
+    average_images(PNG_base_folder, raw_PNG_folder, processed_minutes)
+    save_processed_minutes(processed_minutes_path, processed_minutes)
 
-# Call the average_images function for the current date and last 5 minutes
-average_images(PNG_base_folder, raw_PNG_folder, processed_minutes)
+    # Sleep for 300 seconds minus processing time
+    time.sleep(max(300 - (time.time() - start_time), 0))
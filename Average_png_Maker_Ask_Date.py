@@ -10,8 +10,18 @@ import datetime
 import numpy as np
 from PIL import Image, PngImagePlugin
 import re
+import logging
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from parameters import parameters  # Import the parameters dictionary
+from shared_functions import uint16_array_to_image, average_uint16_images, load_processed_minutes, save_processed_minutes
+
+# Debugging statements go through logging, so they cost nothing unless the level is set to logging.DEBUG below.
+log = logging.getLogger(__name__)
+logging.basicConfig(level=logging.WARNING, format="%(message)s")
+
+# Metadata copied from the first captured spectrogram into the averaged image. Date/Time and Temperature change every minute, so they are read per minute.
+averaged_metadata_keys = ("Exposure Time", "Date/Time", "Temperature", "Binning", "Note")
 
 
 #Function to extract the device name (MISS1 or MISS2) from the metadata. If no metadata present, "MISS2" is returned by default.
@@ -29,73 +39,82 @@ def get_device_name_from_metadata(filepath):
         print(f"Error reading metadata from {os.path.basename(filepath)}: {e}")
         return "MISS2"  # Default to "MISS2" in case of error, change this to MISS1 on MISS1 computer.
 
+# Function to split a spectrogram filename (MISS2-YYYYMMDD-HHMMSS.png) into its date and time parts by slicing, returns None if the filename does not match.
+def split_spectrogram_filename(filename, prefix="MISS2-"): # Change MISS2 to MISS1 on MISS1 computer.
+    if len(filename) != 25 or not filename.startswith(prefix) or not filename.endswith('.png') or filename[14] != '-':
+        return None
+    date_part, time_part = filename[6:14], filename[15:21]
+    if not (date_part.isdigit() and time_part.isdigit()):
+        return None
+    return date_part, time_part
+
+# Function to load a spectrogram as a uint16 array together with its metadata. Returns None if the image could not be read.
+def load_spectrogram(filepath):
+    try:
+        #log.debug("Opening image: %s", filepath)  # DEBUG STATEMENT
+        with Image.open(filepath) as img:
+            img_array = np.asarray(img, dtype=np.uint16)
+            log.debug("Image shape: %s", img_array.shape)  # CHECKING image array shape
+            return img_array, img.info
+    except Exception as e:
+        print(f"Error processing image {os.path.basename(filepath)}: {e}")
+        return None
+
 #Function to average the captured spectrograms minute-wise.
 def average_images(PNG_base_folder, raw_PNG_folder, selected_date, processed_minutes):
     print(f"Starting to process images for {selected_date}")
 
     images_by_minute = defaultdict(list)
-    filename_regex = re.compile(r'^MISS2-(\d{8})-(\d{6})\.png$') # Regex pattern to match filenames with the correct structure.
-    selected_date_obj = datetime.datetime.strptime(selected_date, "%Y%m%d").date()
-
-    # Checking the raw_png_folder to find captured spectrograms.
-    for root, dirs, files in os.walk(raw_PNG_folder):
-        print(f"Checking directory: {root}")  # DEBUG STATEMENT: printing the checked directory.
-        for filename in files:
-            #print(f"Found file: {filename}")  # DEBUG STATEMENT: printing each file found. 
-            filepath = os.path.join(root, filename)
-            match = filename_regex.match(filename)
-            if match:
-                date_part, time_part = match.groups()
-                image_date = datetime.datetime.strptime(date_part, "%Y%m%d").date()
+    now_utc = datetime.datetime.now(datetime.timezone.utc)
+
+    # The captured spectrograms are stored in YYYY/MM/DD folders, so only the folder of the selected date is checked.
+    raw_PNG_folder_date = os.path.join(raw_PNG_folder, selected_date[:4], selected_date[4:6], selected_date[6:8])
+    if not os.path.isdir(raw_PNG_folder_date):
+        print(f"No captured spectrograms found for {selected_date} in {raw_PNG_folder_date}")
+        return
 
-                print(f"Matched Date: {date_part}, Time: {time_part}, File Date: {image_date}, Selected Date: {selected_date_obj}")  # DEBUGGING
+    log.debug("Checking directory: %s", raw_PNG_folder_date)  # DEBUG STATEMENT: printing the checked directory.
+    with os.scandir(raw_PNG_folder_date) as entries:
+        for entry in entries:
+            #log.debug("Found file: %s", entry.name)  # DEBUG STATEMENT: printing each file found. 
+            filename_parts = split_spectrogram_filename(entry.name)
+            if filename_parts:
+                date_part, time_part = filename_parts
+
+                log.debug("Matched Date: %s, Time: %s, Selected Date: %s", date_part, time_part, selected_date)  # DEBUGGING
 
                 # Only process files matching the selected date
-                if image_date == selected_date_obj:
+                if date_part == selected_date:
                     minute_key = date_part + '-' + time_part[:4]
-                    #print(f"Adding file to minute key: {minute_key}")  # DEBUG STATEMENT
-                    images_by_minute[minute_key].append(filepath)
+                    #log.debug("Adding file to minute key: %s", minute_key)  # DEBUG STATEMENT
+                    images_by_minute[minute_key].append(entry.path)
 
     print(f"Found {len(images_by_minute)} minute groups")  # DEBUG STATEMENT: printing the number of minute groups.
 
     #Looping through each group of spectrograms. Grouped by the minute.
     for minute_key, filepaths in images_by_minute.items():
         if len(filepaths) > 0:  # Only process if there are images.
-            print(f"Processing minute: {minute_key}, with {len(filepaths)} images")  # DEBUGGING
+            log.debug("Processing minute: %s, with %s images", minute_key, len(filepaths))  # DEBUGGING
             if minute_key not in processed_minutes:
                 year, month, day, hour, minute = map(int, [minute_key[:4], minute_key[4:6], minute_key[6:8], minute_key[9:11], minute_key[11:]])
                 target_utc = datetime.datetime(year, month, day, hour, minute, tzinfo=datetime.timezone.utc)
 
-                sum_img_array = None
-                count = 0
                 device_name = "MISS2"  # Default device name, change this to MISS1 on MISS1 computer.
-                metadata = None
-
-                # Process the image(s)
-                for filepath in filepaths:
-                    try:
-                        #print(f"Opening image: {filepath}")  # DEBUG STATEMENT
-                        img = Image.open(filepath)
-                        img_array = np.array(img)
-                        print(f"Image shape: {img_array.shape}")  # CHECKING image array shape
 
-                        if sum_img_array is None:
-                            sum_img_array = np.zeros_like(img_array, dtype='float64')
+                # Decode the image(s) concurrently, PIL releases the GIL while decompressing. They are summed in one go below.
+                with ThreadPoolExecutor(max_workers=4) as executor:
+                    loaded_images = [result for result in executor.map(load_spectrogram, filepaths) if result is not None]
+                img_arrays = [img_array for img_array, _ in loaded_images]
 
-                        sum_img_array += img_array
-                        count += 1
+                # Get metadata from the first image only
+                metadata = loaded_images[0][1] if loaded_images else None
 
-                        # Get metadata from the first image only
-                        if metadata is None:
-                            metadata = img.info
-
-                    except Exception as e:
-                        print(f"Error processing image {os.path.basename(filepath)}: {e}")
+                count = len(img_arrays)
 
                 # Now check if count is greater than 0, if yes compute the average and make a 16bit image.
                 if count > 0:
-                    print(f"Count of images for averaging: {count}")  # DEBUG STATEMENT
-                    averaged_image = (sum_img_array / count).astype(np.uint16)
+                    log.debug("Count of images for averaging: %s", count)  # DEBUG STATEMENT
+                    averaged_image = average_uint16_images(img_arrays)
 
                     averaged_PNG_folder = os.path.join(PNG_base_folder)#, "averaged_PNG")
                     os.makedirs(averaged_PNG_folder, exist_ok=True)
@@ -104,40 +123,50 @@ def average_images(PNG_base_folder, raw_PNG_folder, selected_date, processed_min
                     os.makedirs(save_folder, exist_ok=True)
 
                     averaged_image_path = os.path.join(save_folder, f"{device_name}-{year:04d}{month:02d}{day:02d}-{hour:02d}{minute:02d}00.png") #Defining the filename.
-                    #print(f"Saving averaged image to: {averaged_image_path}")  # DEBUG STATEMENT
+                    #log.debug("Saving averaged image to: %s", averaged_image_path)  # DEBUG STATEMENT
 
-                    averaged_img = Image.fromarray(averaged_image, mode='I;16')
+                    averaged_img = uint16_array_to_image(averaged_image)
 
                     pnginfo = PngImagePlugin.PngInfo() #Obtaining metadata 
                     if metadata:
-                        for key, value in metadata.items():
-                            if key in ["Exposure Time", "Date/Time", "Temperature", "Binning", "Note"]:
-                                pnginfo.add_text(key, str(value))   
+                        for key in averaged_metadata_keys:
+                            if key in metadata:
+                                pnginfo.add_text(key, str(metadata[key]))
                         pnginfo.add_text("Note", f"1-minute average image. {metadata.get('Note', '')}")
                     else:
                         pnginfo.add_text("Note", "1-minute average image.")
 
                     try:
-                        averaged_img.save(averaged_image_path, pnginfo=pnginfo)
+                        averaged_img.save(averaged_image_path, pnginfo=pnginfo, compress_level=1) # Fast zlib level, files are only slightly larger than with the default level 6.
                         print(f"Saved averaged image with metadata: {averaged_image_path}")  # DEBUGGING
                     except Exception as e:
                         print(f"Error saving averaged image: {e}")
 
-                    processed_minutes.append(minute_key)  # Keep track of processed minute keys
+                    # Keep track of processed minute keys. Only minutes that are over (including the last exposure) are kept, a minute still being captured is averaged again next time.
+                    if target_utc + datetime.timedelta(minutes=1, seconds=parameters['exposure_duration']) <= now_utc:
+                        processed_minutes.add(minute_key)
                 else:
-                    print(f"No images processed for minute: {minute_key}")  # DEBUGGING
+                    log.debug("No images processed for minute: %s", minute_key)  # DEBUGGING
         else:
-            print(f"Skipping processing for minute: {minute_key}, with 0 images")  # DEBUGGING    
+            log.debug("Skipping processing for minute: %s, with 0 images", minute_key)  # DEBUGGING    
 
 # Get the date input from the user
-selected_date = input("Enter the date (YYYYMMDD) for which to average the images: ")
+selected_date = input("Enter the date (YYYYMMDD) for which to average the images: ").strip()
 
 # Use the parameters dictionary to get paths
 raw_PNG_folder = parameters['raw_PNG_folder'] #'raw_PNG_folder' for normal spectrograms and 'rescaled_PNG_folder' for rescaled spectrograms.
 PNG_base_folder = parameters['averaged_PNG_folder'] #'averaged_PNG_folder' for normal spectrograms and 'rescaled_averaged_PNG_folder' for rescaled spectrograms.
 
-# List to keep track of processed minutes
-processed_minutes = []
-
-# Call the average_images function, starting the averaging
-average_images(PNG_base_folder, raw_PNG_folder, selected_date, processed_minutes)
+# Checking if the date format is correct, the date is used to build the YYYY/MM/DD folder paths.
+try:
+    datetime.datetime.strptime(selected_date, "%Y%m%d")
+except ValueError:
+    print("Invalid date format. Please use YYYYMMDD.")
+else:
+    # Set to keep track of processed minutes, stored next to the averaged images of that day so reruns skip them.
+    processed_minutes_path = os.path.join(PNG_base_folder, selected_date[:4], selected_date[4:6], selected_date[6:8], "processed_minutes.json")
+    processed_minutes = load_processed_minutes(processed_minutes_path)
+
+    # Call the average_images function, starting the averaging
+    average_images(PNG_base_folder, raw_PNG_folder, selected_date, processed_minutes)
+    save_processed_minutes(processed_minutes_path, processed_minutes)
@@ -27,6 +27,7 @@ from PIL import Image, PngImagePlugin
 import AtikSDK
 import time
 from parameters import parameters
+from shared_functions import uint16_array_to_image
 
 # Extract values from parameters
 device_name = parameters['device_name']
@@ -66,38 +67,54 @@ print(f"Cooling set to: {optimal_temperature}")
 
 # Function to cap intenisities according to the threshold value and then rescale the capped intensities to a 16bit range again.
 def rescale_image(img_array, threshold = threshold_value): 
-    img_array[img_array > threshold] = 0  # Omit intensities above the threshold
-    print(f" min intensity after thresholding: {np.min(img_array)}") # Printing the minimum intensity after thresholding
-    print(f" max intensity after thresholding: {np.max(img_array)}") # Printing the maximum intensity after thresholding
-
-    img_rescaled = np.interp(img_array, (img_array.min(), img_array.max()), (0, 65535))  # Rescale to 16-bit range
+    np.putmask(img_array, img_array > threshold, 0)  # Omit intensities above the threshold
+    min_val = img_array.min()
+    max_val = img_array.max()
+    print(f" min intensity after thresholding: {min_val}") # Printing the minimum intensity after thresholding
+    print(f" max intensity after thresholding: {max_val}") # Printing the maximum intensity after thresholding
+
+    # Rescale to 16-bit range with a single subtract and multiply in float64, truncated to uint16 like np.interp followed by astype.
+    scale = 65535.0 / max(int(max_val) - int(min_val), 1)
+    img_rescaled = np.subtract(img_array, min_val, dtype=np.float64)
+    img_rescaled *= scale
     img_rescaled = img_rescaled.astype(np.uint16)
+    img_rescaled[img_array == max_val] = 65535 # np.interp maps the maximum exactly, the product can round just below it.
     return img_rescaled
 
 # main function to capture and save images continuously.
 def capture_and_save_images(base_folder, camera):
+    # Local copies of the settings, they do not change while capturing.
+    cadence = imaging_cadence
+    exposure = exposure_duration
+    name = device_name
+    binning = f"{binX}x{binY}"
+    threshold = threshold_value
+    last_date_folder = None  # Date folder that was last created, so it is only checked again when the date changes.
+
     try:
         while True:
             current_time = datetime.datetime.now(datetime.timezone.utc)
             
             # Capture images only at fixed intervals (every 'imaging_cadence' seconds)
-            if (current_time.second % imaging_cadence != 0):
-                time.sleep(0.5)  # Sleep a bit before checking time again
+            if (current_time.second % cadence != 0):
+                next_capture_second = min((current_time.second // cadence + 1) * cadence, 60)
+                time.sleep(max(0, next_capture_second - current_time.second - current_time.microsecond / 1e6))  # Sleep once until the next capture time
                 continue
 
             # Create the date-based folder structure if it doesn't exist
             date_folder = os.path.join(base_folder, current_time.strftime("%Y/%m/%d"))
-            if not os.path.exists(date_folder):
-                os.makedirs(date_folder)
+            if date_folder != last_date_folder:
+                os.makedirs(date_folder, exist_ok=True)
+                last_date_folder = date_folder
 
             # Capture an image with the specified exposure time
-            image_array = camera.take_image(exposure_duration)
+            image_array = camera.take_image(exposure)
             
             print(f"Image array type: {image_array.dtype}, shape: {image_array.shape}")
             print(f"Image min value: {np.min(image_array)}, max value: {np.max(image_array)}")
 
             uint16_array = image_array.astype(np.uint16) # Converting the image to 16bit and rescale the intensities.
-            uint16_array = rescale_image(uint16_array, threshold=threshold_value)
+            uint16_array = rescale_image(uint16_array, threshold=threshold)
 
             # Retrieve the current temperature
             try:
@@ -109,17 +126,17 @@ def capture_and_save_images(base_folder, camera):
 
             # Save the image with metadata
             timestamp = current_time.strftime("%Y%m%d-%H%M%S")
-            image_path = os.path.join(date_folder, f"{device_name}-{timestamp}.png")
+            image_path = os.path.join(date_folder, f"{name}-{timestamp}.png")
 
             metadata = PngImagePlugin.PngInfo()
-            metadata.add_text("Exposure Time", f"{exposure_duration} seconds")
+            metadata.add_text("Exposure Time", f"{exposure} seconds")
             metadata.add_text("Date/Time", timestamp)
             metadata.add_text("Temperature", f"{current_temperature} C")
-            metadata.add_text("Note", f"{device_name} KHO/UNIS")
-            metadata.add_text("Binning", f"{binX}x{binY}")
+            metadata.add_text("Note", f"{name} KHO/UNIS")
+            metadata.add_text("Binning", binning)
 
-            img = Image.fromarray(uint16_array)
-            img.save(image_path, "PNG", pnginfo=metadata)
+            img = uint16_array_to_image(uint16_array)
+            img.save(image_path, "PNG", pnginfo=metadata, compress_level=1) # Fast zlib level, files are only slightly larger than with the default level 6.
 
             print(f"Saved image: {image_path}")
 
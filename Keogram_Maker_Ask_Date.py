@@ -9,6 +9,7 @@ import os
 import numpy as np
 from PIL import Image
 from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
 import matplotlib.pyplot as plt
 from parameters import parameters  # Import parameters from parameters.py
 
@@ -19,9 +20,10 @@ keogram_dir = parameters['keogram_dir']
 num_pixels_y = parameters['num_pixels_y']
 num_minutes = parameters['num_minutes']
 
-# Initialize an empty keogram with white pixels, dimensions: height = num_pixels_y, width = num_minutes and 3 channels (RGB)
+# Initialize an empty keogram, dimensions: height = num_pixels_y, width = num_minutes and 3 channels (RGB)
+# It is not pre-filled, add_rgb_columns writes the rgb columns and fills only the missing minutes with white pixels.
 def initialise_keogram():
-    return np.full((num_pixels_y, num_minutes, 3), 255, dtype=np.uint8)
+    return np.empty((num_pixels_y, num_minutes, 3), dtype=np.uint8)
 
 # Save the updated keogram with axes and units
 def save_keogram_with_axes(keogram, keogram_dir, spectrograph, date_input, current_date_str):
@@ -32,7 +34,7 @@ def save_keogram_with_axes(keogram, keogram_dir, spectrograph, date_input, curre
     # Create figure for keogram with axes and units
     fig, ax = plt.subplots(figsize=(24, 10))
     #ax.imshow(keogram, aspect='auto', extent=[0, num_minutes, 90, -90]) # Here north is down on vertical axis and south up. This is incorrect, therefore the line below.
-    ax.imshow(keogram, aspect = 'auto', extent= [0, num_minutes, -90, 90]) # Now south is down on vertical axis and north up. This correct I think.
+    ax.imshow(keogram, aspect = 'auto', extent= [0, num_minutes, -90, 90], interpolation='none') # Now south is down on vertical axis and north up. This correct I think.
 
     # Set correct title format for the keogram
     spectrograph_title = "I" if spectrograph == "MISS1" else "II"
@@ -55,55 +57,70 @@ def save_keogram_with_axes(keogram, keogram_dir, spectrograph, date_input, curre
 
     # Save the keogram with axes (without subplots)
     keogram_filename = os.path.join(current_date_dir, f'{spectrograph}-Keogram-{current_date_str}.png')
-    plt.savefig(keogram_filename)
+    plt.savefig(keogram_filename, dpi=72) # A lower dpi renders a much smaller canvas, which is plenty for the 24x10 inch figure.
     plt.close(fig)
 
+# Load a single RGB column, returns (minute, column) or None if the file is corrupted or has an unexpected shape.
+def load_rgb_column(minute, filename, file_path):
+    try:
+        # Decoding the PNG raises if the file is corrupted, no separate integrity check needed.
+        with Image.open(file_path) as img:
+            rgb_data = np.asarray(img)
+
+        # Validate the shape of the image data
+        if rgb_data.shape != (num_pixels_y, 1, 3):
+            print(f"Unexpected image shape {rgb_data.shape} for {filename}. Expected ({num_pixels_y}, 1, 3). Skipping this image.")
+            return None
+
+        # Debugging info: Check the min and max values of the loaded RGB data
+        print(f"Processing {filename} - Min: {rgb_data.min()}, Max: {rgb_data.max()}")
+        return minute, rgb_data.reshape(num_pixels_y, 3)
+
+    except Exception as e:
+        print(f"Corrupted PNG or error processing {filename}: {e}")
+        return None
+
 # Add RGB columns to the keogram
 def add_rgb_columns(keogram, date_str):
     today_RGB_dir = os.path.join(RGB_folder, date_str)
     if not os.path.exists(today_RGB_dir):
         print(f"No RGB directory found for date {date_str}.")
+        keogram[:] = 255
         return keogram
 
-    # Looping over each minute of the day to add corresponding rgb column
+    # Listing the directory once, so checking if a column exists is a set lookup instead of a stat() per minute.
+    with os.scandir(today_RGB_dir) as entries:
+        existing_files = {entry.name for entry in entries}
+
+    # Looping over each minute of the day to find the corresponding rgb column, only HHMM changes in the filename.
+    filename_prefix = f"{spectrograph}-{date_str.replace('/', '')}-"
+    minutes, filenames, file_paths = [], [], []
     for minute in range(num_minutes):
-        timestamp = datetime.strptime(date_str, '%Y/%m/%d') + timedelta(minutes=minute)
-        filename = f"{spectrograph}-{timestamp.strftime('%Y%m%d-%H%M00')}_RGB.png"
+        filename = f"{filename_prefix}{minute // 60:02d}{minute % 60:02d}00_RGB.png"
         file_path = os.path.join(today_RGB_dir, filename)
 
-        if os.path.exists(file_path) and verify_image_integrity(file_path):
-            try:
-                rgb_data = np.array(Image.open(file_path))
-
-                # Validate the shape of the image data
-                if rgb_data.shape != (num_pixels_y, 1, 3):
-                    print(f"Unexpected image shape {rgb_data.shape} for {filename}. Expected ({num_pixels_y}, 1, 3). Skipping this image.")
-                    continue
+        if filename in existing_files:
+            minutes.append(minute)
+            filenames.append(filename)
+            file_paths.append(file_path)
+        else:
+            print(f"File {file_path} does not exist.")
 
-                # Debugging info: Check the min and max values of the loaded RGB data
-                print(f"Processing {filename} - Min: {rgb_data.min()}, Max: {rgb_data.max()}")
+    # Decode the columns concurrently, PIL releases the GIL while decompressing.
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        loaded_columns = [result for result in executor.map(load_rgb_column, minutes, filenames, file_paths) if result is not None]
 
-                keogram[:, minute:minute+1, :] = rgb_data.astype(np.uint8) # Adding the rgb column in the keogram.
+    # Adding all rgb columns in the keogram with a single store.
+    minute_indices = [minute for minute, _ in loaded_columns]
+    if loaded_columns:
+        keogram[:, minute_indices, :] = np.stack([rgb_column for _, rgb_column in loaded_columns], axis=1)
 
-            except Exception as e:
-                print(f"Error processing {filename}: {e}")
-        else:
-            print(f"File {file_path} does not exist or is corrupted.")
+    # Only the minutes without an rgb column are filled with white pixels.
+    missing_minutes = np.setdiff1d(np.arange(num_minutes), minute_indices)
+    keogram[:, missing_minutes, :] = 255
 
     return keogram
 
-# Verify if the image is intact
-def verify_image_integrity(file_path):
-    try:
-        with Image.open(file_path) as img:
-            img.verify()
-        with Image.open(file_path) as img:
-            img.load()
-        return True
-    except Exception as e:
-        print(f"Corrupted PNG detected: {file_path} - {e}")
-        return False
-
 #Main function 
 def main():
     date_input = input("Enter the date for the keogram (YYYY/MM/DD): ")
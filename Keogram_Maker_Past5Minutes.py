@@ -18,8 +18,11 @@ Updated by Jesse Delbressine (UNIS & TU/e)
 
 import os
 import numpy as np
-from PIL import Image
+import cv2
 from datetime import datetime, timezone, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import matplotlib
+matplotlib.use('Agg') # Non-interactive backend, the keogram is only saved to file.
 import matplotlib.pyplot as plt
 import time
 from parameters import parameters  # Import parameters from parameters.py
@@ -31,6 +34,10 @@ keogram_dir = parameters['keogram_dir']
 num_pixels_y = parameters['num_pixels_y']
 num_minutes = parameters['num_minutes']
 
+plt.rcParams['figure.autolayout'] = False
+
+# The keogram figure is built once and reused for every save, only the image data and title change between updates.
+keogram_fig, keogram_ax, keogram_im = None, None, None
 
 # Initialise an empty keogram with white pixels,  dimensions: height = num_pixels_y, width = num_minutes and 3 channels (RGB)
 def initialise_keogram():
@@ -45,43 +52,67 @@ def save_keogram_with_axes(keogram, keogram_dir, spectrograph, date_input):
     current_date_dir = os.path.join(keogram_dir, current_date_str[:4], current_date_str[4:6], current_date_str[6:8])
     os.makedirs(current_date_dir, exist_ok=True)
 
-    # Create figure for keogram with axes and units
-    fig, ax = plt.subplots(figsize=(24, 10))
-    ax.imshow(keogram, aspect='auto', extent=[0, num_minutes, -90, 90]) # South is down on vertical axis and north up
+    global keogram_fig, keogram_ax, keogram_im
+    if keogram_fig is None:
+        # Create figure for keogram with axes and units
+        keogram_fig, keogram_ax = plt.subplots(figsize=(24, 10))
+        keogram_im = keogram_ax.imshow(keogram, aspect='auto', extent=[0, num_minutes, -90, 90]) # South is down on vertical axis and north up
+
+        # Set axis labels and ticks
+        keogram_ax.set_xlabel("Time (UT)", fontsize=20)
+        keogram_ax.set_ylabel("Elevation angle [degrees]", fontsize=20)
+
+        # Set x-axis ticks for time (every 2 hours)
+        x_ticks = np.arange(0, num_minutes + 1, 120)
+        x_labels = [(datetime(2024, 1, 1) + timedelta(minutes=int(t))).strftime('%H:%M') for t in x_ticks]
+        keogram_ax.set_xticks(x_ticks)
+        keogram_ax.set_xticklabels(x_labels, fontsize = 24)
+
+        # Set y-axis ticks for elevation angle
+        y_ticks = np.linspace(-90, 90, 7)
+        keogram_ax.set_yticks(y_ticks)
+        keogram_ax.set_yticklabels(['90° S', '60° S', '30° S', 'Zenith', '30° N', '60° N', '90° N'], fontsize = 24)
+    else:
+        keogram_im.set_data(keogram)
 
     # Set correct title format for the keogram
     spectrograph_title = "I" if spectrograph == "MISS1" else "II"
-    ax.set_title(f"Meridian Imaging Svalbard Spectrograph {spectrograph_title} {date_input}", fontsize=28)
-
-    # Set axis labels and ticks
-    ax.set_xlabel("Time (UT)", fontsize=20)
-    ax.set_ylabel("Elevation angle [degrees]", fontsize=20)
-
-    # Set x-axis ticks for time (every 2 hours)
-    x_ticks = np.arange(0, num_minutes + 1, 120)
-    x_labels = [(datetime(2024, 1, 1) + timedelta(minutes=int(t))).strftime('%H:%M') for t in x_ticks]
-    ax.set_xticks(x_ticks)
-    ax.set_xticklabels(x_labels, fontsize = 24)
-
-    # Set y-axis ticks for elevation angle
-    y_ticks = np.linspace(-90, 90, 7)
-    ax.set_yticks(y_ticks)
-    ax.set_yticklabels(['90° S', '60° S', '30° S', 'Zenith', '30° N', '60° N', '90° N'], fontsize = 24)
+    keogram_ax.set_title(f"Meridian Imaging Svalbard Spectrograph {spectrograph_title} {date_input}", fontsize=28)
 
     # Save the keogram with axes (without subplots) on this computer.
     keogram_filename = os.path.join(current_date_dir, f'{spectrograph}-keogram-{current_date_str}.png')
-    plt.savefig(keogram_filename)
+    keogram_fig.savefig(keogram_filename, dpi=100, pil_kwargs={'compress_level': 3})
 
     # Save the keogram with axes and upload it to KHO website.
     #keogram_filename2 = os.path.join('Z:\\kho\\MISS2', 'latest-keogram.png') # Directory needs to be changed for MISS1.
-    #plt.savefig(keogram_filename2)
-    
-    plt.close(fig)
+    #keogram_fig.savefig(keogram_filename2, dpi=100, pil_kwargs={'compress_level': 3})
+
+# Load a single RGB column, returns (minute, column) or None if it is missing, corrupted or has an unexpected shape.
+def load_rgb_column(minute, filename, file_path):
+    # A single decode with OpenCV (releases the GIL), imread returns None for a missing or corrupted PNG so no separate integrity check is needed.
+    bgr_data = cv2.imread(file_path, cv2.IMREAD_UNCHANGED)
+    if bgr_data is None:
+        print(f"Corrupted or missing PNG detected: {file_path}")
+        return None
+
+    # Validate the shape of the image data
+    if bgr_data.shape != (num_pixels_y, 1, 3):
+        print(f"Unexpected image shape {bgr_data.shape} for {filename}. Expected ({num_pixels_y}, 1, 3). Skipping this image.")
+        return None
+    rgb_data = bgr_data[:, :, ::-1] # OpenCV loads channels as BGR.
+
+    # Debugging info: Check the min and max values of the loaded RGB data
+    print(f"Processing {filename} - Min: {rgb_data.min()}, Max: {rgb_data.max()}")
+    return minute, rgb_data
 
 # Add all available RGB columns from 00:00 UTC to now(current UTC time) to the keogram
 def add_rgb_columns(keogram, date_str, now):
     today_RGB_dir = os.path.join(RGB_folder, date_str)
-    if not os.path.exists(today_RGB_dir):
+
+    # List the day directory once, the per-minute lookups below are then done in memory instead of one stat call each.
+    try:
+        entries = {entry.name: entry.path for entry in os.scandir(today_RGB_dir)}
+    except FileNotFoundError:
         print(f"No RGB directory found for date {date_str}.")
         return keogram
 
@@ -91,44 +122,37 @@ def add_rgb_columns(keogram, date_str, now):
     # Determining how many minutes have passed since 00:00 UTC
     minutes_passed = int((now - start_time).total_seconds() // 60)
 
-    # Loop through all the RGB columns from 00:00UTC to current UTC
-    for minute in range(minutes_passed):
-        timestamp = start_time + timedelta(minutes=minute)
-        filename = f"{spectrograph}-{timestamp.strftime('%Y%m%d-%H%M00')}_RGB.png"
-        file_path = os.path.join(today_RGB_dir, filename)
-
-        if os.path.exists(file_path) and verify_image_integrity(file_path):
-            try:
-                rgb_data = np.array(Image.open(file_path))
-
-                # Validate the shape of the image data
-                if rgb_data.shape != (num_pixels_y, 1, 3):
-                    print(f"Unexpected image shape {rgb_data.shape} for {filename}. Expected ({num_pixels_y}, 1, 3). Skipping this image.")
-                    continue
-
-                # Debugging info: Check the min and max values of the loaded RGB data
-                print(f"Processing {filename} - Min: {rgb_data.min()}, Max: {rgb_data.max()}")
-                
-                keogram[:, minute:minute+1, :] = rgb_data.astype(np.uint8)
-
-            except Exception as e:
-                print(f"Error processing {filename}: {e}")
-
+    # The RGB column makers also write all columns of the day into one raw file, reading it replaces decoding every PNG column.
+    # Minutes that are still white in the raw file (columns made before it existed) are filled from the PNG columns below.
+    minutes_in_raw_file = np.zeros(minutes_passed, dtype=bool)
+    raw_filename = f"keogram_raw_{start_time.strftime('%Y%m%d')}.bin"
+    if raw_filename in entries:
+        raw_path = entries[raw_filename]
+        if os.path.getsize(raw_path) == num_minutes * num_pixels_y * 3:
+            raw_columns = np.memmap(raw_path, dtype=np.uint8, mode='r', shape=(num_minutes, num_pixels_y, 3))[:minutes_passed]
+            keogram[:, :minutes_passed, :] = raw_columns.transpose(1, 0, 2)
+            minutes_in_raw_file = (raw_columns != 255).any(axis=(1, 2)) # A scaled RGB column is never all white.
+            print(f"Keogram columns read from {raw_path}")
         else:
-            print(f"File {file_path} does not exist or is corrupted.")
-    return keogram
+            print(f"Unexpected size of {raw_path}, using the PNG columns instead.")
+
+    # All the available RGB columns from 00:00UTC to current UTC that are not in the raw file
+    minutes, filenames = [], []
+    for minute in np.flatnonzero(~minutes_in_raw_file):
+        filename = f"{spectrograph}-{(start_time + timedelta(minutes=int(minute))).strftime('%Y%m%d-%H%M00')}_RGB.png"
+        if filename in entries:
+            minutes.append(minute)
+            filenames.append(filename)
+    file_paths = [entries[filename] for filename in filenames]
+
+    # The columns are loaded concurrently (PNG decoding releases the GIL), the keogram itself is only written here.
+    with ThreadPoolExecutor(max_workers=16) as executor:
+        for result in executor.map(load_rgb_column, minutes, filenames, file_paths):
+            if result is not None:
+                minute, rgb_data = result
+                keogram[:, minute:minute+1, :] = rgb_data
 
-# Verify if the image is intact
-def verify_image_integrity(file_path):
-    try:
-        with Image.open(file_path) as img:
-            img.verify()
-        with Image.open(file_path) as img:
-            img.load()
-        return True
-    except Exception as e:
-        print(f"Corrupted PNG detected: {file_path} - {e}")
-        return False
+    return keogram
 
 # Main function
 def main():
@@ -149,4 +173,8 @@ def main():
     print(f"Keogram for {date_input} has been created successfully.")
 
 if __name__ == "__main__":
-    main()
+    # Keep running and update the keogram every 300 seconds, instead of being restarted for every run.
+    while True:
+        start_time = time.time()
+        main()
+        time.sleep(max(300 - (time.time() - start_time), 0)) # Sleep for 300 seconds minus processing time
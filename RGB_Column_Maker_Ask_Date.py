@@ -5,12 +5,12 @@ Jesse Delbressine (UNIS & TU/e)
 '''
 #THIS PROGRAM IS STILL WORK IN PROGRESS ;)
 import os
+from functools import lru_cache
 import numpy as np
-from scipy import signal
 from PIL import Image
 from datetime import datetime, timezone
 from parameters import parameters  # Import parameters from parameters.py
-from scipy.ndimage import zoom  # For ensuring that RGB column has the correct shape.
+from shared_functions import trimmed_row_mean, write_rgb_column_to_raw_file
 
 # Extract paths and constants from parameters.py
 spectro_path = parameters['spectro_path']
@@ -52,25 +52,12 @@ def ensure_directory_exists(directory):
     else:
         print(f"Directory already exists: {directory}")
 
-# Verify image integrity
-def verify_image_integrity(file_path):
-    try:
-        with Image.open(file_path) as img:
-            img.verify()
-        with Image.open(file_path) as img:
-            img.load()
-        return True
-    except Exception as e:
-        print(f"Corrupted PNG detected: {file_path} - {e}")
-        return False
-
-# Read the PNG image, apply binning correction and extract metadata
-def read_png_with_metadata(filename, binX, binY):
+# Read the PNG image and extract metadata with a single open and decode. The data is kept binned, the binning is accounted for in the row and column indices instead of upsampling the image.
+def read_png_with_metadata(filename):
     with Image.open(filename) as img:
-        raw_data = np.array(img)
         metadata = img.info
-        corrected_data = zoom(raw_data, (binY, binX), order = 1) # order = 1 applies bilinear interpolation.
-    return corrected_data, metadata
+        raw_data = np.asarray(img)
+    return raw_data, metadata
 
 
 # Extracting the binning factors from the metadata.
@@ -87,60 +74,60 @@ def extract_binning_from_metadata(metadata):
 def calculate_k_lambda(wavelengths, coeffs):
     return np.polyval(coeffs, wavelengths)
 
-# Process and average emission line rows
-def process_emission_line(spectro_array, emission_row, binY, pixel_range, min_rows_for_average=2):
-    print(f"Processing emission line for row {emission_row} with binY {binY}")
+# Sample positions for resampling a row of the given width to the 300 pixel column, these only depend on the width so they are computed once.
+@lru_cache(maxsize=None)
+def column_sample_positions(row_width):
+    return np.linspace(0, row_width - 1, 300), np.arange(row_width)
+
+# Process and average the rows of the three emission lines in one pass over the spectrogram, returns a (3, 300) array (red, green, blue).
+def extract_three_rows(spectro_array, emission_rows, binY, pixel_range, min_rows_for_average=2):
+    print(f"Processing emission lines for rows {emission_rows} with binY {binY}")
     num_rows_to_average = max(1, int(12 / binY)) # Determining number of rows to average based on binning factor. 
-    #start_row = max(0, emission_row - binY // 2) # Defining start and end rows for the region of interest.
-    start_row = max(0, emission_row - num_rows_to_average // 2)
-    end_row = min(spectro_array.shape[0], emission_row + num_rows_to_average // 2 + 1)
-    available_rows = end_row - start_row
-    if available_rows < min_rows_for_average:
-        print(f"Not enough rows for averaging at row {emission_row}, ({available_rows}<{min_rows_for_average})")
-        return None
-    
-    # Crop and process the region of interest from the spectrogram.
+    start_rows = [max(0, emission_row - num_rows_to_average // 2) for emission_row in emission_rows] # Defining start and end rows for the regions of interest.
+    end_rows = [min(spectro_array.shape[0], emission_row + num_rows_to_average // 2 + 1) for emission_row in emission_rows]
+    for emission_row, start_row, end_row in zip(emission_rows, start_rows, end_rows):
+        available_rows = end_row - start_row
+        if available_rows < min_rows_for_average:
+            print(f"Not enough rows for averaging at row {emission_row}, ({available_rows}<{min_rows_for_average})")
+            return None
+
+    # Crop the region of interest from the spectrogram (a view, nothing is copied).
     spectro_array_cropped = spectro_array[:, pixel_range[0]:pixel_range[1]]
-    extracted_rows = spectro_array_cropped[start_row:end_row, :]
+    strip_heights = [end_row - start_row for start_row, end_row in zip(start_rows, end_rows)]
 
-    #Apply median filter smoothing out the rows and average the rows.
-    processed_rows = signal.medfilt2d(extracted_rows.astype('float32'))
-    averaged_row = np.mean(processed_rows, axis=0)
+    # Trimmed mean over the rows, the same reduction as the live RGB column maker so both give the same columns for a spectrogram.
+    if len(set(strip_heights)) == 1:
+        # All three strips have the same height, so they are gathered into one (3, height, width) stack.
+        row_indices = np.array(start_rows)[:, None] + np.arange(strip_heights[0])
+        averaged_rows = trimmed_row_mean(spectro_array_cropped[row_indices])
+    else:
+        # A strip was clipped at the edge of the spectrogram, so each strip is averaged on its own.
+        averaged_rows = np.stack([trimmed_row_mean(spectro_array_cropped[start_row:end_row]) for start_row, end_row in zip(start_rows, end_rows)])
 
-    # Rescale the averaged row to fit the desired columns size (300 pixels)
-    rescaled_row = zoom(averaged_row, (300 / len(averaged_row)))
-    print(f"Processed emission line for row {emission_row}")
-    return rescaled_row.flatten()
+    # Rescale the averaged rows to fit the desired columns size (300 pixels)
+    sample_positions, row_positions = column_sample_positions(averaged_rows.shape[1])
+    rescaled_rows = np.empty((3, 300), dtype=np.float32)
+    for i in range(3):
+        rescaled_rows[i] = np.interp(sample_positions, row_positions, averaged_rows[i])
+    print(f"Processed emission lines for rows {emission_rows}")
+    return rescaled_rows
 
 # Create RGB column from emission line data 
 def create_rgb_column(spectro_array, row_6300, row_5577, row_4278, binY, pixel_range, k_lambda_6300, k_lambda_5577, k_lambda_4278):
-    column_RED = process_emission_line(spectro_array, row_6300, binY, pixel_range) # Process red, green and blue channels from emission lines
-    column_GREEN = process_emission_line(spectro_array, row_5577, binY, pixel_range)
-    column_BLUE = process_emission_line(spectro_array, row_4278, binY, pixel_range)
+    emission_rows = extract_three_rows(spectro_array, (row_6300, row_5577, row_4278), binY, pixel_range) # Process red, green and blue channels from emission lines
     
-    if column_RED is None or column_GREEN is None or column_BLUE is None:
+    if emission_rows is None:
         print(f"Image will be skipped due to missing emission line data.")
         return None
     
-   #Applying k_lambda
-    column_RED = column_RED * k_lambda_6300
-    column_GREEN = column_GREEN * k_lambda_5577
-    column_BLUE = column_BLUE * k_lambda_4278
-
-    
-    def scale_channel(channel_data, scale_factor): # The scale factor is now set to 1, can be adjusted for better colouring.
-        min_val = np.min(channel_data)
-        max_val = np.max(channel_data)
-        range_val = max_val - min_val
-        print(f"Channel min value: {min_val}, max value: {max_val}, range: {range_val}")
-        return np.clip(((channel_data - min_val) / range_val) * 255 *scale_factor, 0, 255).astype(np.uint8) if range_val != 0 else np.zeros_like(channel_data, dtype=np.uint8)
-    
-    
-    # Scale and reshape each channel
-    column_RED = scale_channel(column_RED, scale_factor=1).reshape(300, 1)
-    column_GREEN = scale_channel(column_GREEN, scale_factor=1).reshape(300, 1)
-    column_BLUE = scale_channel(column_BLUE,scale_factor=1).reshape(300, 1)
-    true_rgb_image = np.stack((column_RED, column_GREEN, column_BLUE), axis=-1) # Stack channels to form final rgb column.
+   #Applying k_lambda and stretching the three channels to 0-255 in one pass, a flat channel becomes black.
+    channels = emission_rows * np.array([[k_lambda_6300], [k_lambda_5577], [k_lambda_4278]], dtype=np.float32) # Shape (3, 300).
+    min_vals = channels.min(axis=1, keepdims=True)
+    max_vals = channels.max(axis=1, keepdims=True)
+    range_vals = np.where(max_vals > min_vals, max_vals - min_vals, 1)
+    print(f"Channel min values: {min_vals.ravel()}, max values: {max_vals.ravel()}")
+    scaled = np.clip((channels - min_vals) * (255.0 / range_vals), 0, 255).astype(np.uint8)
+    true_rgb_image = scaled.T[:, None, :] # Reshape to the final (300, 1, 3) rgb column.
     if true_rgb_image.shape != (300, 1, 3):
         print(f"Error: RGB image has an incorrect shape {true_rgb_image.shape}. Expected shape: (300, 1, 3)")
         return None
@@ -160,26 +147,23 @@ def create_rgb_columns_for_date(date_str):
         return
     for filename in matching_files:
         png_file_path = os.path.join(spectro_path_dir, filename)
-        if not verify_image_integrity(png_file_path):
-            print(f"Skipping corrupted image: {filename}")
-            continue
-        try:
-            spectro_data, metadata = read_png_with_metadata(png_file_path, 1, 1) # (1,1) used as placeholders. They are replaced with actual value later.
+        try: # A corrupted PNG raises when it is read below and is skipped, no separate integrity check needed.
+            spectro_data, metadata = read_png_with_metadata(png_file_path)
             binX, binY = extract_binning_from_metadata(metadata)
             print(f" binX = {binX} and binY = {binY}")
             if binX is None or binY is None:
                 print(f"Skipping file due to failed binning factor extraction {filename}")
                 continue
-            spectro_data, metadata = read_png_with_metadata(png_file_path, binX, binY) # Reloading spectro_data with the actual binning values
 
             if "MISS1" in filename:
-                pixel_range = miss1_horizon_limits
+                horizon_limits = miss1_horizon_limits
                 coeffs = miss1_wavelength_coeffs 
             elif "MISS2" in filename:
-                pixel_range = miss2_horizon_limits
+                horizon_limits = miss2_horizon_limits
                 coeffs = miss2_wavelength_coeffs
             else:
                 continue
+            pixel_range = (horizon_limits[0] // binX, horizon_limits[1] // binX) # Horizon limits in binned pixel columns.
             emission_wavelengths = [6300, 5577, 4278] # Define emission wavelengths for auroral lines. 
             max_pixel_value = spectro_data.shape[0] - 1 
             row_6300 = calculate_pixel_position(emission_wavelengths[0], coeffs, max_pixel_value, binY) # Calculate row positions for each emission line
@@ -201,13 +185,13 @@ def create_rgb_columns_for_date(date_str):
             RGB_image = create_rgb_column(spectro_data, row_6300, row_5577, row_4278, binY, pixel_range, k_lambda_6300, k_lambda_5577, k_lambda_4278)
             if RGB_image is None:
                 continue
-            RGB_pil_image = Image.fromarray(RGB_image.astype('uint8'), mode='RGB')
-            resized_RGB_image = RGB_pil_image.resize((1, 300), Image.LANCZOS)
+            RGB_pil_image = Image.fromarray(RGB_image.astype('uint8')) # Already (300, 1, 3), no resizing needed.
 
             filename_without_ext, ext = os.path.splitext(filename)
             output_filename = f"{filename_without_ext}_RGB.png"
             output_path = os.path.join(output_folder, output_filename)
-            resized_RGB_image.save(output_path)
+            RGB_pil_image.save(output_path, optimize=False, compress_level=1) # Fast zlib level, the (300, 1, 3) column is tiny so the size difference is negligible.
+            write_rgb_column_to_raw_file(output_folder, filename_without_ext, np.asarray(RGB_pil_image))
             print(f"Saved RGB image: {output_filename}")
         except Exception as e:
             print(f"Failed to process {filename}: {e}")
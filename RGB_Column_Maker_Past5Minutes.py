@@ -13,12 +13,16 @@ Jesse Delbressine (UNIS & TU/e)
 """
 
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 import numpy as np
-from scipy import signal
+import cv2
 from PIL import Image
 from datetime import datetime, timezone, timedelta
 import time
 from parameters import parameters  # Import parameters from parameters.py
+from shared_functions import trimmed_row_mean, write_rgb_column_to_raw_file
 
 # Extract paths and constants from parameters.py
 spectro_path = parameters['spectro_path']
@@ -30,8 +34,10 @@ coeffs_sensitivity_miss2 = parameters['coeffs_sensitivity']['MISS2']
 miss1_horizon_limits = parameters['miss1_horizon_limits']
 miss2_horizon_limits = parameters['miss2_horizon_limits']
 
-processed_images = set()
+processed_images = set() # (filename, modification time in ns) of the spectrograms that already have an RGB column.
 current_day = datetime.now(timezone.utc).day
+processed_images_lock = threading.Lock() # Guards processed_images and the raw daily column file, the spectrograms are processed by a thread pool.
+thread_buffers = threading.local() # Scaling buffers of each worker thread, reused across the files that thread processes.
 
 # Function to calculate pixel position from wavelength using the spectral fit coefficients and binning factor
 def calculate_pixel_position(wavelength, coeffs, max_pixel_value, binY):
@@ -61,25 +67,17 @@ def ensure_directory_exists(directory):
     if not os.path.exists(directory):
         os.makedirs(directory)
 
-# Verify image integrity
-def verify_image_integrity(file_path):
-    try:
-        with Image.open(file_path) as img:
-            img.verify()
-        with Image.open(file_path) as img:
-            img.load()
-        return True
-    except Exception as e:
-        print(f"Corrupted PNG detected: {file_path} - {e}")
-        return False
-
-# Read the PNG image and extract metadata
-def read_png_with_metadata(filename, binX, binY):
+# Read the PNG image and extract metadata. The data is kept binned, the binning is accounted for in the row and column indices instead of upsampling the image.
+def read_png_with_metadata(filename):
     with Image.open(filename) as img:
-        raw_data = np.array(img)
-        metadata = img.info  # Extract metadata
-        corrected_data = zoom(raw_data, (binY, binX), order = 1)
-    return corrected_data, metadata
+        metadata = dict(img.info)  # Extract metadata, the text chunks come before the image data so PIL parses them without decoding the pixels
+        raw_data = cv2.imread(filename, cv2.IMREAD_UNCHANGED) # 16-bit decode straight into a uint16 array with libpng
+        if raw_data is None or raw_data.ndim != 2:
+            # Not a greyscale PNG OpenCV could decode, fall back to PIL
+            img.load()
+            raw_data = np.asarray(img)
+            metadata = dict(img.info)
+    return raw_data, metadata
 
 # Extract binning factor from metadata (use binY)
 def extract_binning_from_metadata(metadata):
@@ -95,73 +93,175 @@ def extract_binning_from_metadata(metadata):
 def calculate_k_lambda(wavelengths, coeffs):
     return np.polyval(coeffs, wavelengths)
 
-# Process the emission line rows in the spectrogram and average them.
-def process_emission_line(spectro_array, emission_row, binY, pixel_range, min_rows_for_average=2):
-    num_rows_to_average = max(1, int(12 / binY))
-    start_row = max(emission_row - num_rows_to_average // 2, 0)
-    #end_row = min(emission_row + num_rows_to_average // 2, spectro_array.shape[0])
-    end_row = min(spectro_array.shape[0], emission_row + num_rows_to_average // 2 + 1)
+# Emission line wavelengths in Angstroms
+emission_wavelengths = (6300, 5577, 4278)  # Adjust wavelengths as needed [Å]
 
+# Spectral fit and sensitivity coefficients per spectrograph type
+wavelength_coeffs = {"MISS1": miss1_wavelength_coeffs, "MISS2": miss2_wavelength_coeffs}
+sensitivity_coeffs = {"MISS1": coeffs_sensitivity_miss1, "MISS2": coeffs_sensitivity_miss2}
 
-    # Check if enough rows are available for averaging
-    available_rows = end_row - start_row
-    if available_rows < min_rows_for_average:
-        print(f"Not enough rows for averaging at row {emission_row}, ({available_rows}<{min_rows_for_average})")
+# Rows of the three emission lines, these only depend on the spectrograph, binning and image height so they are computed once per combination.
+@lru_cache(maxsize=16)
+def emission_line_rows(spectrograph_type, binY, max_pixel_value):
+    rows = [calculate_pixel_position(wavelength, wavelength_coeffs[spectrograph_type], max_pixel_value, binY) for wavelength in emission_wavelengths]
+    if None in rows:
         return None
+    # Round pixel positions to nearest integer. Fit lambda(pixel_row) is starting from last pixel!!!
+    return tuple(max_pixel_value - int(round(row)) for row in rows)
+
+# Calibration factors k_lambda of the three emission lines for a spectrograph type.
+@lru_cache(maxsize=16)
+def emission_line_k_lambdas(spectrograph_type):
+    return tuple(calculate_k_lambda(wavelength, sensitivity_coeffs[spectrograph_type]) for wavelength in emission_wavelengths)
+
+# Linear interpolation weights for resampling a row of the given width to the 300 pixel column, this only depends on the width so it is computed once.
+@lru_cache(maxsize=16)
+def column_interpolation_matrix(row_width):
+    sample_positions = np.linspace(0, row_width - 1, 300)
+    lower_columns = np.floor(sample_positions).astype(int)
+    fractions = sample_positions - lower_columns
+    weights = np.zeros((300, row_width), dtype=np.float32)
+    output_rows = np.arange(300)
+    weights[output_rows, lower_columns] = 1 - fractions
+    weights[output_rows, np.clip(lower_columns + 1, 0, row_width - 1)] += fractions
+    return weights
+
+# Process the rows of the three emission lines in the spectrogram and average them, returns a (3, 300) array (red, green, blue).
+def extract_three_rows(spectro_array, emission_rows, binY, pixel_range, min_rows_for_average=2):
+    num_rows_to_average = max(1, int(12 / binY))
+    start_rows = [max(emission_row - num_rows_to_average // 2, 0) for emission_row in emission_rows]
+    end_rows = [min(spectro_array.shape[0], emission_row + num_rows_to_average // 2 + 1) for emission_row in emission_rows]
+
+    # Check if enough rows are available for averaging
+    for emission_row, start_row, end_row in zip(emission_rows, start_rows, end_rows):
+        available_rows = end_row - start_row
+        if available_rows < min_rows_for_average:
+            print(f"Not enough rows for averaging at row {emission_row}, ({available_rows}<{min_rows_for_average})")
+            return None
     
     # Crop the array to the desired pixel range (columns)
     spectro_array_cropped = spectro_array[:, pixel_range[0]:pixel_range[1]]
-    extracted_rows = spectro_array_cropped[start_row:end_row, :]
-    
-    #Apply a median filter
-    processed_rows = signal.medfilt2d(extracted_rows.astype('float32'))
-    averaged_row = np.mean(processed_rows, axis=0)
-
-    # Rescale the averaged row to fit 300 pixels
-    rescaled_row = zoom(averaged_row, (300 / len(averaged_row)))  # Maybe this causes the error?
-    return rescaled_row.flatten()
-
-# Function to create the RGB image from the extracted rows
-def create_rgb_column(spectro_array, row_6300, row_5577, row_4278, binY, pixel_range, k_lamba_6300, k_lambda_5577, k_lambda_4278 ):
-    # Process each emission line and extract the corresponding rows
-    column_RED = process_emission_line(spectro_array, row_6300, binY, pixel_range)
-    column_GREEN = process_emission_line(spectro_array, row_5577, binY, pixel_range)
-    column_BLUE = process_emission_line(spectro_array, row_4278, binY, pixel_range)
-
-    if column_RED is None or column_GREEN is None or column_BLUE is None:
+
+    # Trimmed mean over the rows, dropping the row-wise min and max rejects spikes like the 3x3 median filter did before averaging
+    if len({end_row - start_row for start_row, end_row in zip(start_rows, end_rows)}) == 1:
+        # The three strips have the same height, so they are gathered with one index into a (3, rows, columns) stack and averaged together.
+        row_indices = np.array(start_rows)[:, None] + np.arange(end_rows[0] - start_rows[0])
+        averaged_rows = trimmed_row_mean(spectro_array_cropped[row_indices])
+    else:
+        # A strip was clipped at the edge of the spectrogram, so each strip is averaged on its own.
+        averaged_rows = np.stack([trimmed_row_mean(spectro_array_cropped[start_row:end_row, :]) for start_row, end_row in zip(start_rows, end_rows)])
+
+    # Rescale the averaged rows to fit 300 pixels, only along the columns
+    return averaged_rows @ column_interpolation_matrix(averaged_rows.shape[1]).T
+
+# Function to create the RGB image from the extracted rows. The scaling buffers can be passed in so they are reused across files.
+def create_rgb_column(spectro_array, row_6300, row_5577, row_4278, binY, pixel_range, k_lambda_6300, k_lambda_5577, k_lambda_4278, scale_buffer=None, rgb_buffer=None):
+    # Process the three emission lines and extract the corresponding rows
+    emission_rows = extract_three_rows(spectro_array, (row_6300, row_5577, row_4278), binY, pixel_range)
+
+    if emission_rows is None:
         print(f"Image will be skipped due to missing emission line data.")
         return None
+    if scale_buffer is None:
+        scale_buffer = np.empty((3, 300), dtype=np.float64)
+    if rgb_buffer is None:
+        rgb_buffer = np.empty((300, 1, 3), dtype=np.uint8)
         
     #Applying k_lambda
-    column_RED = column_RED * k_lambda_6300
-    column_GREEN = column_GREEN * k_lambda_5577
-    column_BLUE = column_BLUE * k_lambda_4278
-
-    
-    def scale_channel(channel_data, scale_factor): # Scale factor is now set to one, change accordingly for hopefully better colours.
-        min_val = np.min(channel_data)
-        max_val = np.max(channel_data)
-        range_val = max_val - min_val
-        print(f"Channel min value: {min_val}, max value: {max_val}, range: {range_val}")
-        return np.clip(((channel_data - min_val) / range_val) * 255 *scale_factor, 0, 255).astype(np.uint8) if range_val != 0 else np.zeros_like(channel_data, dtype=np.uint8)
-    
-    
-    # Scale and reshape each channel
-    scaled_red_channel = scale_channel(column_RED, scale_factor=1).reshape(300, 1)
-    scaled_green_channel = scale_channel(column_GREEN, scale_factor=1).reshape(300, 1)
-    scaled_blue_channel = scale_channel(column_BLUE,scale_factor=1).reshape(300, 1)
-    
-
-    # Combine the individually scaled channels into the final RGB image
-    true_rgb_image = np.stack((scaled_red_channel, scaled_green_channel, scaled_blue_channel), axis=-1)
-
-    true_rgb_image_flipped = np.flipud(true_rgb_image) # Flipping the RGB column since I thought they were upside down.
+    np.multiply(emission_rows, [[k_lambda_6300], [k_lambda_5577], [k_lambda_4278]], out=emission_rows)
+
+    # Scale each channel to 0-255 in place, a flat channel becomes black. Scale factor is one, change the 255 accordingly for hopefully better colours.
+    min_vals = emission_rows.min(axis=1, keepdims=True)
+    max_vals = emission_rows.max(axis=1, keepdims=True)
+    range_vals = max_vals - min_vals
+    print(f"Channel min values: {min_vals.ravel()}, max values: {max_vals.ravel()}, ranges: {range_vals.ravel()}")
+    scale_factors = np.divide(255.0, range_vals, out=np.zeros_like(range_vals), where=range_vals != 0)
+    np.subtract(emission_rows, min_vals, out=scale_buffer)
+    np.multiply(scale_buffer, scale_factors, out=scale_buffer)
+    np.clip(scale_buffer, 0, 255, out=scale_buffer)
+
+    # Combine the scaled channels into the final (300, 1, 3) RGB image, written bottom-up so the column stays contiguous
+    rgb_buffer[::-1, 0, :] = scale_buffer.T # Flipping the RGB column since I thought they were upside down.
+    true_rgb_image_flipped = rgb_buffer
     if true_rgb_image_flipped.shape != (300, 1, 3):
         print(f"Error: RGB image has an incorrect shape {true_rgb_image_flipped.shape}. Expected shape: (300, 1, 3)")
         return None
     print(f"Succesfull created RGB column.")
     return true_rgb_image_flipped
 
+# Create the RGB column of a single spectrogram, called from the thread pool in create_rgb_columns.
+def process_spectrogram_png(entry, output_folder):
+    filename = entry.name
+    png_file_path = entry.path
+
+    # Skip spectrograms that already have an RGB column and have not changed since
+    image_key = (filename, entry.stat().st_mtime_ns)
+    with processed_images_lock:
+        if image_key in processed_images:
+            print(f"Skipping {filename}, it has already been processed.")
+            return
+
+    # Each worker thread has its own scaling buffers, the RGB column is saved before the thread makes its next one.
+    if not hasattr(thread_buffers, "scale_buffer"):
+        thread_buffers.scale_buffer = np.empty((3, 300), dtype=np.float64)
+        thread_buffers.rgb_buffer = np.empty((300, 1, 3), dtype=np.uint8)
+
+    try: # A corrupted PNG raises when it is read below and is skipped, no separate integrity check needed.
+        # Read image and extract metadata
+        spectro_data, metadata = read_png_with_metadata(png_file_path)
+        binX, binY = extract_binning_from_metadata(metadata)
+        print(f" binX = {binX} and binY = {binY}")
+
+        if binX is None or binY is None:
+            print(f"Skipping file due to failed binning factor extraction {filename}")
+            return
+
+        # Determine the spectrograph type (MISS1 or MISS2) from the filename
+        if "MISS1" in filename:
+            spectrograph_type = "MISS1"
+            horizon_limits = miss1_horizon_limits
+        elif "MISS2" in filename:
+            spectrograph_type = "MISS2"
+            horizon_limits = miss2_horizon_limits
+        else:
+            print(f"Unknown spectrograph type for {filename}")
+            return
+        pixel_range = (horizon_limits[0] // binX, horizon_limits[1] // binX) # Horizon limits in binned pixel columns.
+
+        # Pixel positions (rows) for each emission line
+        max_pixel_value = spectro_data.shape[0] - 1  # Maximum valid pixel index (rows)
+        emission_rows = emission_line_rows(spectrograph_type, binY, max_pixel_value)
+        if emission_rows is None:
+            print(f"Skipping {filename} due to missing emission line data.")
+            return
+        row_6300, row_5577, row_4278 = emission_rows
+
+        # k_lambda values for each emission line to apply calibration
+        k_lambda_6300, k_lambda_5577, k_lambda_4278 = emission_line_k_lambdas(spectrograph_type)
+
+        # Use calculated rows and k_lambda values to create RGB columns
+        RGB_image = create_rgb_column(
+            spectro_data, row_6300, row_5577, row_4278, binY, pixel_range, 
+            k_lambda_6300, k_lambda_5577, k_lambda_4278, thread_buffers.scale_buffer, thread_buffers.rgb_buffer)
+
+        if RGB_image is None:
+            print(f"RGB column creation failed for {filename}")
+            return
+
+        resized_RGB_image = Image.fromarray(np.ascontiguousarray(RGB_image)) # Already (300, 1, 3) uint8, no resizing needed.
+
+        # Save the RGB image
+        rgb_filename = filename.replace(".png", "_RGB.png")
+        rgb_image_output_path = os.path.join(output_folder, rgb_filename)
+        resized_RGB_image.save(rgb_image_output_path, optimize=False, compress_level=1) # Fast zlib level, the (300, 1, 3) column is tiny so the size difference is negligible.
+        with processed_images_lock:
+            write_rgb_column_to_raw_file(output_folder, os.path.splitext(filename)[0], np.asarray(resized_RGB_image))
+            processed_images.add(image_key)
+        print(f"Saved RGB image: {rgb_image_output_path}")
+
+    except Exception as e:
+        print(f"Failed to process {filename}: {e}")
+
 # Process images to create RGB columns, main function
 def create_rgb_columns():
     global processed_images, current_day
@@ -173,6 +273,8 @@ def create_rgb_columns():
     if current_time_UT.day != current_day:
         processed_images.clear()
         current_day = current_time_UT.day
+        emission_line_rows.cache_clear()
+        emission_line_k_lambdas.cache_clear()
 
     # Ensuring the directories exists
     spectro_path_dir = os.path.join(spectro_path, current_time_UT.strftime("%Y/%m/%d"))
@@ -181,96 +283,23 @@ def create_rgb_columns():
     output_folder = os.path.join(output_folder_base, current_time_UT.strftime("%Y/%m/%d"))
     ensure_directory_exists(output_folder)
 
-    matching_files = [f for f in os.listdir(spectro_path_dir) if f.endswith(".png")] # Finding all the files in the directory.
+    # Finding the PNG files modified within the last 5 minutes, scandir gives the modification time without an extra stat call per file on most platforms.
+    five_minutes_ago_timestamp = five_minutes_ago.timestamp()
+    with os.scandir(spectro_path_dir) as directory_entries:
+        matching_files = [entry for entry in directory_entries if entry.name.endswith(".png") and entry.stat().st_mtime >= five_minutes_ago_timestamp]
 
     if not matching_files:
         print("No PNG files found to process => SKIPPING")
         return
 
-    for filename in matching_files:
-        png_file_path = os.path.join(spectro_path_dir, filename)
-
-        # Check if the file was modified within the last 5 minutes
-        file_mod_time = datetime.utcfromtimestamp(os.path.getmtime(png_file_path)).replace(tzinfo=timezone.utc)
-        if file_mod_time < five_minutes_ago:
-            print(f"Skipping {filename}, it is older than 5 minutes.")
-            continue
-
-        if not verify_image_integrity(png_file_path):
-            print(f"Skipping corrupted image: {filename}")
-            continue
-
-        try:
-
-            # Read image and extract metadata
-            spectro_data, metadata = read_png_with_metadata(png_file_path, 1, 1) # (1,1) used as placeholders. They are replaced with actual value later.
-            binX, binY = extract_binning_from_metadata(metadata)
-            print(f" binX = {binX} and binY = {binY}")
-
-            if binX is None or binY is None:
-                print(f"Skipping file due to failed binning factor extraction {filename}")
-                continue
-            spectro_data, metadata = read_png_with_metadata(png_file_path, binX, binY) #Reloading spectro_data with the actual binning values
-
-      
-
-        # Determine the spectrograph type (MISS1 or MISS2) from the filename
-        if "MISS1" in filename:
-            pixel_range = miss1_horizon_limits
-            coeffs = miss1_wavelength_coeffs
-            coeffs_sensitivity = coeffs_sensitivity_miss1
-        elif "MISS2" in filename:
-            pixel_range = miss2_horizon_limits
-            coeffs = miss2_wavelength_coeffs
-            coeffs_sensitivity = coeffs_sensitivity_miss2
-        else:
-            print(f"Unknown spectrograph type for {filename}")
-            continue
-
-        # Define emission line wavelengths in Angstroms
-        emission_wavelengths = [6300, 5577, 4278]  # Adjust wavelengths as needed [Å]
-
-        # Calculate the pixel positions (rows) for each emission line
-        max_pixel_value = spectro_data.shape[0] - 1  # Maximum valid pixel index (rows)
-        row_6300 = calculate_pixel_position(emission_wavelengths[0], coeffs, max_pixel_value, binY)
-        row_5577 = calculate_pixel_position(emission_wavelengths[1], coeffs, max_pixel_value, binY)
-        row_4278 = calculate_pixel_position(emission_wavelengths[2], coeffs, max_pixel_value, binY)
-
-       if row_6300 is None or row_5577 is None or row_4278 is None:
-                print(f"Skipping {filename} due to missing emission line data.")
-                continue
-
-        # Round pixel positions to nearest integer. Fit lambda(pixel_row) is starting from last pixel!!!
-        row_6300 = max_pixel_value - int(round(row_6300))
-        row_5577 = max_pixel_value - int(round(row_5577))
-        row_4278 = max_pixel_value - int(round(row_4278))
-
-        # Calculate k_lambda values for each emission line to apply calibration
-        k_lambda_6300 = calculate_k_lambda(6300, coeffs_sensitivity)
-        k_lambda_5577 = calculate_k_lambda(5577, coeffs_sensitivity)
-        k_lambda_4278 = calculate_k_lambda(4278, coeffs_sensitivity)
-
-        # Use calculated rows and k_lambda values to create RGB columns
-        RGB_image = create_rgb_column(
-            spectro_data, row_6300, row_5577, row_4278, binY, pixel_range, 
-            k_lambda_6300, k_lambda_5577, k_lambda_4278)
-
-        if RGB_image is None:
-            print(f"RGB column creation failed for {filename}")
-            continue
-            
-        RGB_pil_image = Image.fromarray(RGB_image.astype('uint8'), mode='RGB')
-        resized_RGB_image = RGB_pil_image.resize((1, 300), Image.LANCZOS)
-
-       # Save the RGB image
-        rgb_filename = filename.replace(".png", "_RGB.png")
-        rgb_image_output_path = os.path.join(output_folder, rgb_filename)
-        resized_RGB_image.save(rgb_image_output_path)
-        print(f"Saved RGB image: {rgb_image_output_path}")
-
-    except Exception as e:
-        print(f"Failed to process {filename}: {e}")
+    # The spectrograms are independent, PNG decoding and numpy release the GIL so a few threads overlap reading and processing.
+    with ThreadPoolExecutor(max_workers=min(8, len(matching_files))) as executor:
+        list(executor.map(process_spectrogram_png, matching_files, [output_folder] * len(matching_files)))
 
 
 if __name__ == "__main__":
-    create_rgb_columns()
+    # Keep running and create the RGB columns of the last 5 minutes every 300 seconds, instead of being restarted for every run.
+    while True:
+        start_time = time.time()
+        create_rgb_columns()
+        time.sleep(max(300 - (time.time() - start_time), 0)) # Sleep for 300 seconds minus processing time
@@ -5,7 +5,7 @@ with spectral and spatial analysis and keogram based on latest available data fr
 1. Initialise a list to track subprocesses.
 2. Define a function to terminate all subprocesses safely (ctrl + C).
 3. Launche multiple subprocesses (keogram maker, RGB column maker, average PNG maker, kho_website_feed, spectrogram processor, and Feeder).
-4. Enter a loop to keep processes running, checking every 60 seconds.
+4. Enter a loop to keep processes running, checking every 300 seconds and restarting any process that has stopped.
 5. On interrupt, stop all subprocesses and exits.
 
 Author: Nicolas Martinez (UNIS/LTU)
@@ -21,6 +21,16 @@ import time
 processes = []  # List to keep track of all subprocesses
 running = True  # Manage the while loop
 
+# Scripts that are started once and keep running, each of them repeats its own work every 300s.
+scripts = [
+    "Average_Png_MakerPast5Minutes.py",
+    "Spectrogram_Processor_Past5Minutes.py",
+    "RGB_Column_Maker_Past5Minutes.py",
+    "Keogram_Maker_Past5Minutes.py",
+    #"KHO_WEBSITE_DATA-FEED.py",
+    #"Routine_eraser.py",
+]
+
 #This function will stop all subprocesses.
 def stop_processes(processes, timeout=5):
     for process in processes:
@@ -56,47 +66,36 @@ def verify_processes(processes):
             all_running = False
     return all_running
 
+#This function will restart the subprocesses that have stopped, the ones still running are left alone.
+def restart_stopped_processes(processes, scripts):
+    for i, (process, script_name) in enumerate(zip(processes, scripts)):
+        if process.poll() is not None:
+            print(f"Process {process.pid} ({script_name}) has stopped with exit code {process.returncode}, restarting it.")
+            processes[i] = start_subprocess(script_name)
+
 if __name__ == "__main__":
     signal.signal(signal.SIGINT, signal_handler)
     
-    #In order to let the subprocesses start right away and not wait the 300s before it starts.
-    processes.append(start_subprocess("Average_png_maker_Past5Minutes.py"))
-    time.sleep(10)
-    processes.append(start_subprocess("Spectrogram_Processor_Past5Minutes.py"))
-    time.sleep(10)
-    processes.append(start_subprocess("RGB_Column_Maker_Past5Minutes.py"))
-    time.sleep(10)
-    processes.append(start_subprocess("Keogram_Maker_Past5Minutes.py"))
-    time.sleep(10)
-
+    # The subprocesses are started once, they keep running and repeat their work every 300s themselves.
+    for script_name in scripts:
+        processes.append(start_subprocess(script_name))
+        time.sleep(10)
+
+    if verify_processes(processes): # Confirming that all subprocesses have started.
+        print("All subprocesses started successfully.")
+    else:
+        print("One or more subprocesses failed to start.")
     
     last_execution_time = time.time()
 
     try:
         while running:
             current_time = time.time()
-            if current_time - last_execution_time >= 300: #300s wait for the next iteration.
+            if current_time - last_execution_time >= 300: #300s wait for the next check.
                 last_execution_time = current_time
 
-                # Stop and clear existing processes
-                stop_processes(processes)
-                processes = []
-
-                # Start new processes
-                processes.append(start_subprocess("Average_png_maker_Past5Minutes.py"))
-                time.sleep(10)
-                processes.append(start_subprocess("Spectrogram_Processor_Past5Minutes.py"))
-                time.sleep(10)
-                processes.append(start_subprocess("RGB_Column_Maker_Past5Minutes.py"))
-                time.sleep(10)
-                processes.append(start_subprocess("Keogram_Maker_Past5Minutes.py"))
-                #processes.append(start_subprocess("KHO_WEBSITE_DATA-FEED.py"))
-                #processes.append(start_subprocess("Routine_eraser.py"))
-
-                if verify_processes(processes): # Confirming that all subprocesses have started.
-                    print("All subprocesses started successfully.")
-                else:
-                    print("One or more subprocesses failed to start.")
+                # Only restart subprocesses that have crashed or exited
+                restart_stopped_processes(processes, scripts)
 
             time.sleep(1)
 
@@ -6,8 +6,9 @@ J.J. Delbressine (UNIS & TU/e)
 '''
 
 import numpy as np
+import matplotlib
+matplotlib.use('Agg') # Non-interactive backend, the spectrograms are only saved to file.
 import matplotlib.pyplot as plt
-from scipy.ndimage import rotate
 from PIL import Image
 import os
 import re
@@ -22,6 +23,9 @@ miss2_wavelength_coeffs = parameters['miss2_wavelength_coeffs']
 averaged_PNG_folder = parameters['averaged_PNG_folder']
 processed_spectrogram_dir = parameters['processed_spectrogram_dir']
 
+# Figures are built once per spectrograph type, image shape and binning, and reused for all spectrograms of the day by swapping their data.
+spectrogram_figures = {}
+
 # Function to calculate wavelengths from the pixel, a.k.a. wavelength pixel relation.
 def calculate_wavelength(pixel_columns, coeffs):
     wavelengths = coeffs[0] + coeffs[1] * pixel_columns + coeffs[2] * (pixel_columns ** 2)
@@ -52,30 +56,39 @@ def extract_binning_from_metadata(metadata):
         print(f"Error extracting binning factor from metadata: {e}")
         return None, None 
 
-# Function to process and plot spectrograms
-def process_and_plot_with_flip_and_rotate(image_array, spectrograph_type, save_path, timestamp_str, binX, binY):
+# Wavelengths and k_lambda of the columns of the rotated spectrogram, these only depend on the spectrograph, the number of columns and binY so they are computed once per combination.
+def calculate_calibration(spectrograph_type, num_columns, binY):
+    if spectrograph_type == "MISS1":
+        wavelengths = calculate_wavelength(np.arange(num_columns) * binY, miss1_wavelength_coeffs)
+        k_lambda = calculate_k_lambda(wavelengths, coeffs_sensitivity_miss1)
+    elif spectrograph_type == "MISS2":
+        wavelengths = calculate_wavelength(np.arange(num_columns) * binY, miss2_wavelength_coeffs)
+        k_lambda = calculate_k_lambda(wavelengths, coeffs_sensitivity_miss2)
+    else:
+        raise ValueError("Unknown spectrograph type. Please choose 'MISS1' or 'MISS2'.")
+    wavelength_range = wavelengths[::binY]
+    return wavelengths, k_lambda, wavelength_range
+
+# Function to process and plot spectrograms, calibration is the (wavelengths, k_lambda, wavelength_range) tuple from calculate_calibration.
+def process_and_plot_with_flip_and_rotate(image_array, spectrograph_type, save_path, timestamp_str, binX, binY, calibration):
     print(f"Original image shape: {image_array.shape}")
     flipped_image = np.flipud(image_array) # Flip the spectrogram
     #background = np.median(flipped_image, axis=0) # Calculating background by taking the median along the columns.
     #background_subtracted_image = np.clip(flipped_image - background[np.newaxis, :], 0, None) # Substract the background and clip values to ensure only positive pixel values present.
-    #rotated_image = rotate(background_subtracted_image, angle=90, reshape=True) # Rotating the image 90 degrees.
-    rotated_image = rotate(flipped_image, angle=90, reshape=True) # Rotating the image 90 degrees.
+    #rotated_image = np.rot90(background_subtracted_image, k=1) # Rotating the image 90 degrees.
+    rotated_image = np.rot90(flipped_image, k=1) # Rotating the image 90 degrees counter-clockwise, an exact index permutation (view) instead of a spline interpolation.
     
-    # Choose the spectrograph type and apply relevant coefficients
+    # Choose the spectrograph type, the calibration is precomputed by the caller
+    wavelengths, k_lambda, wavelength_range = calibration
     if spectrograph_type == "MISS1":
-        wavelengths = calculate_wavelength(np.arange(rotated_image.shape[1]) * binY, miss1_wavelength_coeffs)
-        k_lambda = calculate_k_lambda(wavelengths, coeffs_sensitivity_miss1)
         fov_start, fov_end = parameters['miss1_horizon_limits']
     elif spectrograph_type == "MISS2":
-        wavelengths = calculate_wavelength(np.arange(rotated_image.shape[1]) * binY, miss2_wavelength_coeffs)
-        k_lambda = calculate_k_lambda(wavelengths, coeffs_sensitivity_miss2)
         fov_start, fov_end = parameters['miss2_horizon_limits']
     else:
         raise ValueError("Unknown spectrograph type. Please choose 'MISS1' or 'MISS2'.")
 
     #Adjusting the binned FOV portion from the rotated image for spatial analysis
     fov_start_binned, fov_end_binned = fov_start // binX, fov_end // binX
-    wavelength_range = wavelengths[::binY]
 
     #Extracting the binned FOV portion from the rotated image for spatial analysis
     binned_image = rotated_image[::binX, :: binY]
@@ -83,51 +96,67 @@ def process_and_plot_with_flip_and_rotate(image_array, spectrograph_type, save_p
 
     elevation_scale = np.linspace(fov_start, fov_end, binned_image_fov.shape[0]) # Matching the length to spatial_avg, elevation scale from -90 to 90 degrees
 
-    # Plot the results
-    fig = plt.figure(figsize=(12, 8))
-    fig.suptitle(f"Processed {spectrograph_type} Spectrogram - {timestamp_str} UTC", fontsize=18)
-    gs = plt.GridSpec(3, 2, width_ratios=[5, 1], height_ratios=[1, 4, 1])
-
-    ax_main = fig.add_subplot(gs[1, 0])
-
-    #ax_main.imshow(rotated_image, cmap='gray', aspect='auto', extent=[wavelengths.min(), wavelengths.max(), 0, rotated_image.shape[0]])
-    ax_main.imshow(np.sqrt(np.clip(rotated_image, 0, None)), cmap='gray', aspect='auto', extent=[wavelengths.min(), wavelengths.max(), 0, rotated_image.shape[0]])
-    
-    tick_positions = np.linspace(fov_start_binned, fov_end_binned, num=7)
-    tick_labels = ["South", "-60", "-30", "Zenith", "30", "60", "North"]
-    ax_main.set_yticks(tick_positions)
-    ax_main.set_yticklabels(tick_labels, fontsize = 14)
-    ax_main.set_xlabel("Wavelength [Å]", fontsize=16)
-    ax_main.tick_params(axis='x', labelsize = 14) # CHECK IF THIS IS CORRECT
-    ax_main.set_ylabel("Elevation [Degrees]", fontsize=16)
-    ax_main.grid(False)
-
-    ax_spectral = fig.add_subplot(gs[0, 0])
+    # Data of the three plots
+    display_image = np.sqrt(np.clip(rotated_image, 0, None))
     spectral_avg = np.mean(binned_image * k_lambda[np.newaxis, :len(wavelength_range)], axis = 0)/1000 # converting to kR/Å
-    ax_spectral.plot(wavelength_range[:len(spectral_avg)], spectral_avg)
-    ax_spectral.set_ylabel("Spectral Radiance [kR/Å]", fontsize=13)
-    ax_spectral.set_title("Spectral Analysis", fontsize=16)
-    ax_spectral.tick_params(axis='both', which= 'major', labelsize = 14)
-    ax_spectral.grid()
-
-    ax_spatial = fig.add_subplot(gs[1, 1])
     spatial_avg = np.mean(rotated_image[fov_start_binned:fov_end_binned,:] * k_lambda[np.newaxis, :], axis=1) / 1000 # calculating spatial average across the rows in kR/Å.
     spatial_avg_flipped = np.flip(spatial_avg)
     #elevation_scale = np.linspace(-90, 90, spatial_avg.shape[0]) # Representing the elevation range
     elevation_scale = np.linspace(-90, 90, spatial_avg_flipped.shape[0])
-    ax_spatial.plot(spatial_avg, elevation_scale)
-    ax_spatial.set_xlabel("Spatial Radiance [kR/θ]", fontsize=13)
-    ax_spatial.set_title("Spatial Analysis", fontsize=16)
-    ax_spatial.set_yticks(np.linspace(-90, 90, num=9))
-    ax_spatial.set_yticklabels(["South", "-60", "-45", "-30", "Zenith", "30", "45", "60", "North"])
-    ax_spectral.tick_params(axis='both', which= 'major', labelsize = 14)
-    ax_spatial.grid()
 
-    plt.tight_layout()
+    figure_key = (spectrograph_type, image_array.shape, binX, binY)
+    if figure_key not in spectrogram_figures:
+        # Plot the results
+        fig = plt.figure(figsize=(12, 8))
+        fig.suptitle(f"Processed {spectrograph_type} Spectrogram - {timestamp_str} UTC", fontsize=18)
+        gs = plt.GridSpec(3, 2, width_ratios=[5, 1], height_ratios=[1, 4, 1])
+
+        ax_main = fig.add_subplot(gs[1, 0])
+
+        #ax_main.imshow(rotated_image, cmap='gray', aspect='auto', extent=[wavelengths.min(), wavelengths.max(), 0, rotated_image.shape[0]])
+        main_image = ax_main.imshow(display_image, cmap='gray', aspect='auto', extent=[wavelengths.min(), wavelengths.max(), 0, rotated_image.shape[0]])
+        
+        tick_positions = np.linspace(fov_start_binned, fov_end_binned, num=7)
+        tick_labels = ["South", "-60", "-30", "Zenith", "30", "60", "North"]
+        ax_main.set_yticks(tick_positions)
+        ax_main.set_yticklabels(tick_labels, fontsize = 14)
+        ax_main.set_xlabel("Wavelength [Å]", fontsize=16)
+        ax_main.tick_params(axis='x', labelsize = 14) # CHECK IF THIS IS CORRECT
+        ax_main.set_ylabel("Elevation [Degrees]", fontsize=16)
+        ax_main.grid(False)
+
+        ax_spectral = fig.add_subplot(gs[0, 0])
+        spectral_line, = ax_spectral.plot(wavelength_range[:len(spectral_avg)], spectral_avg)
+        ax_spectral.set_ylabel("Spectral Radiance [kR/Å]", fontsize=13)
+        ax_spectral.set_title("Spectral Analysis", fontsize=16)
+        ax_spectral.tick_params(axis='both', which= 'major', labelsize = 14)
+        ax_spectral.grid()
+
+        ax_spatial = fig.add_subplot(gs[1, 1])
+        spatial_line, = ax_spatial.plot(spatial_avg, elevation_scale)
+        ax_spatial.set_xlabel("Spatial Radiance [kR/θ]", fontsize=13)
+        ax_spatial.set_title("Spatial Analysis", fontsize=16)
+        ax_spatial.set_yticks(np.linspace(-90, 90, num=9))
+        ax_spatial.set_yticklabels(["South", "-60", "-45", "-30", "Zenith", "30", "45", "60", "North"])
+        ax_spectral.tick_params(axis='both', which= 'major', labelsize = 14)
+        ax_spatial.grid()
+
+        fig.tight_layout()
+        spectrogram_figures[figure_key] = (fig, main_image, spectral_line, spatial_line, ax_spectral, ax_spatial)
+    else:
+        # Reuse the figure, only the data and the autoscaled limits change. The layout of the first spectrogram is kept.
+        fig, main_image, spectral_line, spatial_line, ax_spectral, ax_spatial = spectrogram_figures[figure_key]
+        fig.suptitle(f"Processed {spectrograph_type} Spectrogram - {timestamp_str} UTC", fontsize=18)
+        main_image.set_data(display_image)
+        main_image.autoscale() # Grey scale limits of the new image, as a new imshow would set them.
+        spectral_line.set_ydata(spectral_avg)
+        spatial_line.set_xdata(spatial_avg)
+        for ax in (ax_spectral, ax_spatial):
+            ax.relim()
+            ax.autoscale_view()
 
     # Save the figure, including all subplots
-    plt.savefig(save_path, format='png', bbox_inches='tight')
-    plt.close(fig)
+    fig.savefig(save_path, format='png', bbox_inches='tight', pil_kwargs={'compress_level': 3})
 
 
 # Function to process all the spectrograms for the input date
@@ -136,6 +165,7 @@ def process_spectrograms_for_day(averaged_PNG_folder, processed_spectrogram_dir,
     date_to_process = datetime.strptime(input_date, '%Y%m%d')
     start_of_day = date_to_process.replace(hour=0, minute=0, second=0, tzinfo=None)
     end_of_day = start_of_day + timedelta(days=1)
+    calibration_cache = {} # (spectrograph_type, number of columns, binY) -> calibration, identical for all spectrograms of the day.
 
     # Walk through the average_PNG_folder 
     for root, _, files in os.walk(averaged_PNG_folder):
@@ -152,7 +182,13 @@ def process_spectrograms_for_day(averaged_PNG_folder, processed_spectrogram_dir,
                     if start_of_day <= timestamp < end_of_day:
                         image_path = os.path.join(root, file)
                         print(f"Processing image: {image_path}")
-                        image_array = np.array(Image.open(image_path))
+                        with Image.open(image_path) as img:
+                            image_array = np.array(img)
+                            metadata = img.info
+                        binX, binY = extract_binning_from_metadata(metadata)
+                        if binX is None or binY is None:
+                            print(f"Skipping file due to failed binning factor extraction {file}")
+                            continue
 
                         if "MISS1" in file:
                             spectrograph_type = "MISS1"
@@ -168,8 +204,13 @@ def process_spectrograms_for_day(averaged_PNG_folder, processed_spectrogram_dir,
                         processed_image_name = f"{spectrograph_type}-ProcessedSpectrogram-{timestamp_str}.png"
                         save_path = os.path.join(date_folder, processed_image_name)
 
+                        # Wavelengths and k_lambda, the rotated image has one column per row of the spectrogram
+                        calibration_key = (spectrograph_type, image_array.shape[0], binY)
+                        if calibration_key not in calibration_cache:
+                            calibration_cache[calibration_key] = calculate_calibration(spectrograph_type, image_array.shape[0], binY)
+
                         # Process and save the figure
-                        process_and_plot_with_flip_and_rotate(image_array, spectrograph_type, save_path, timestamp_str)
+                        process_and_plot_with_flip_and_rotate(image_array, spectrograph_type, save_path, timestamp_str, binX, binY, calibration_cache[calibration_key])
                         print(f"Processed and saved spectrogram: {save_path}")
 
 
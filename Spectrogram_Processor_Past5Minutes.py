@@ -1,11 +1,11 @@
 """
 This script processes averaged spectrogram images from the MISS1 and MISS2 spectrographs. 
-It handles image orientation (flipping and rotating), performs background subtraction, and 
+It handles image orientation (flipping and rotating) and 
 applies wavelength and sensitivity calibration to prepare the data for spectral and spatial analysis.
 
 Steps:
 1. Monitors a directory for new images every five minutes.
-2. Processes the images by flipping, rotating, subtracting background, and calibrating.
+2. Processes the images by flipping, rotating and calibrating.
 3. Generates and saves plots for spectral and spatial analysis, accounting for any binning of the spectrogram.
 
 Author: Nicolas Martinez (UNIS/LTU)
@@ -14,15 +14,23 @@ Updated by Jesse Delbressine (UNIS & TU/e)
 """
 
 import numpy as np
+import matplotlib
+matplotlib.use('Agg') # Non-interactive backend, the spectrograms are only saved to file.
 import matplotlib.pyplot as plt
-from scipy.ndimage import rotate
 from PIL import Image
 import os
+import shutil
 import time
-from datetime import datetime, timezone
+from datetime import datetime, timezone, timedelta
 import re
+import logging
+from concurrent.futures import ProcessPoolExecutor
 from parameters import parameters  # Import parameters from parameters.py
 
+# Debugging statements go through logging, so they cost nothing unless log_level in parameters.py is set to 'DEBUG'.
+log = logging.getLogger(__name__)
+logging.basicConfig(level=parameters['log_level'], format="%(message)s")
+
 # Extract parameters from the parameters dictionary
 coeffs_sensitivity_miss1 = parameters['coeffs_sensitivity']['MISS1']
 coeffs_sensitivity_miss2 = parameters['coeffs_sensitivity']['MISS2']
@@ -32,147 +40,211 @@ averaged_PNG_folder = parameters['averaged_PNG_folder']
 processed_spectrogram_dir = parameters['processed_spectrogram_dir']
 binX = parameters['binX']
 binY = parameters['binY']
+compress_level = parameters['compress_level']
+
+calibration_cache = {} # (spectrograph_type, number of columns) -> (wavelengths, k_lambda in kR/Å, wavelength_range), identical for all spectrograms of an instrument.
+
+# Figures are built once per spectrograph type and image shape, and reused for every following spectrogram by swapping their data.
+spectrogram_figures = {}
 
 # Function to calculate wavelengths based on the pixel, a.k.a. wavelength pixel relation.
 def calculate_wavelength(pixel_columns, coeffs):
     wavelengths = coeffs[0] + coeffs[1] * pixel_columns + coeffs[2] * (pixel_columns ** 2)
-    print(f"Calculated wavelengths: {wavelengths[:10]}...")  # Debugging: Show first 10 wavelengths
+    log.debug("Calculated wavelengths: %s...", wavelengths[:10])  # Debugging: Show first 10 wavelengths
     return wavelengths
 
 # Function to calculate calibration coefficient K_lambda, needed for radiometric calibration. 
+# Horner's scheme in place, evaluated in float64 since the terms of the MISS2 fit nearly cancel (0.2% error in float32), and returned as float32 for the image arithmetic.
 def calculate_k_lambda(wavelengths, coeffs):
-    k_lambda = np.polyval(coeffs, wavelengths)
-    print(f"Calculated k_lambda values (first 10): {k_lambda[:10]}")
+    wavelengths = np.asarray(wavelengths, dtype=np.float64)
+    k_lambda = np.full_like(wavelengths, coeffs[0])
+    for coeff in coeffs[1:]:
+        k_lambda *= wavelengths
+        k_lambda += coeff
+    k_lambda = k_lambda.astype(np.float32)
+    log.debug("Calculated k_lambda values (first 10): %s", k_lambda[:10])
     if np.any(k_lambda < 0):
-        print("Warning: Negative k_lambda values detected.")  # Warning for negative k_lambda values
+        log.warning("Warning: Negative k_lambda values detected.")  # Warning for negative k_lambda values
     return k_lambda
 
+# Read a spectrogram PNG into a uint16 array, decoded once by PIL and wrapped by numpy without an extra full-image copy.
+def load_png(path):
+    with Image.open(path) as img:
+        img.load()
+        return np.asarray(img, dtype=np.uint16)
+
 # Function to process and plot spectrograms
-def process_and_plot_with_flip_and_rotate(image_array, spectrograph_type, filename):
-    print(f"Original image shape: {image_array.shape}")
-    flipped_image = np.flipud(image_array)
+def process_and_plot_with_flip_and_rotate(image_array, spectrograph_type, save_path, timestamp_str):
+    log.debug("Original image shape: %s", image_array.shape)
+    # All the arithmetic below is done in float32, the PNG holds at most 16-bit values. The cast is the only copy, the flip stays a negative-stride view.
+    flipped_image = np.flipud(image_array.astype(np.float32, copy=False))
     #background = np.median(flipped_image, axis=0) # Calculating background by taking the median along the columns.
     #background_subtracted_image = np.clip(flipped_image - background[np.newaxis, :], 0, None) # Substract the background and clip values to ensure only positive pixel values.
-    #rotated_image = rotate(background_subtracted_image, angle=90, reshape=True)
-    rotated_image = rotate(flipped_image, angle=90, reshape=True) # Rotating image 90 degrees
+    #rotated_image = np.rot90(background_subtracted_image, k=1)
+    rotated_image = np.rot90(flipped_image, k=1) # Rotating image 90 degrees counter-clockwise, an exact index permutation (view) instead of a spline interpolation.
     # ABOVE is outcommented since that background substraction is too strong, maybe use a fixed background which needs to be subtracted.
     
-    # Choose the spectrograph type and apply relevant coefficients
+    # Choose the spectrograph type and apply relevant coefficients, the calibration is only computed for the first spectrogram of each type and width
     if spectrograph_type == "MISS1":
-        wavelengths = calculate_wavelength(np.arange(rotated_image.shape[1]) * binY, miss1_wavelength_coeffs)
-        k_lambda = calculate_k_lambda(wavelengths, coeffs_sensitivity_miss1)
+        wavelength_coeffs, sensitivity_coeffs = miss1_wavelength_coeffs, coeffs_sensitivity_miss1
         fov_start, fov_end = parameters['miss1_horizon_limits']
     elif spectrograph_type == "MISS2":
-        wavelengths = calculate_wavelength(np.arange(rotated_image.shape[1]) * binY, miss2_wavelength_coeffs)
-        k_lambda = calculate_k_lambda(wavelengths, coeffs_sensitivity_miss2)
+        wavelength_coeffs, sensitivity_coeffs = miss2_wavelength_coeffs, coeffs_sensitivity_miss2
         fov_start, fov_end = parameters['miss2_horizon_limits']
     else:
         raise ValueError("Unknown spectrograph type. Please choose 'MISS1' or 'MISS2'.")
+    calibration_key = (spectrograph_type, rotated_image.shape[1])
+    if calibration_key not in calibration_cache:
+        pixel_columns = np.arange(rotated_image.shape[1]) * binY # Allocated once per spectrograph type and width
+        wavelengths = calculate_wavelength(pixel_columns, wavelength_coeffs)
+        k_lambda = calculate_k_lambda(wavelengths, sensitivity_coeffs)
+        calibration_cache[calibration_key] = (wavelengths, k_lambda[np.newaxis, :] / 1000, wavelengths[::binY]) # k_lambda converted to kR/Å once, wavelength_range is a view
+    wavelengths, k_lambda_scaled, wavelength_range = calibration_cache[calibration_key]
 
     # #Adjusting the binned FOV portion from the rotated image for spatial analysis
     fov_start_binned, fov_end_binned = fov_start // binX, fov_end // binX
-    wavelength_range = wavelengths[::binY]
 
     # Extract the binned FOV portion from the rotated image for spatial analysis
     binned_image = rotated_image[::binX, ::binY]
-    binned_image_fov = binned_image[fov_start_binned:fov_end_binned, :]  # Limiting FOV within binned image
-
-    elevation_scale = np.linspace(fov_start, fov_end, binned_image_fov.shape[0])# Matching the length to spatial_avg # Elavation scale from -90 to 90 degrees
 
+    # Data of the three plots
+    display_image = np.sqrt(rotated_image) # No clip needed, the spectrogram values are non-negative since no background is subtracted
+    # k_lambda only scales the columns, so it is applied after the row mean and as a matrix-vector product over the columns instead of calibrating full-image copies.
+    spectral_avg = np.mean(binned_image, axis=0) * k_lambda_scaled[0, :len(wavelength_range)] # In kR/Å
+    spatial_avg = rotated_image[fov_start_binned:fov_end_binned,:] @ k_lambda_scaled[0] / rotated_image.shape[1]  # In kR/Å
+
+    figure_key = (spectrograph_type, image_array.shape)
+    if figure_key not in spectrogram_figures:
+        # The elevation scale and tick positions only depend on the FOV of the image shape, so they are only made with the figure and reused with it.
+        elevation_scale = np.linspace(-90, 90, spatial_avg.shape[0])  # Representing the elevation range.
+
+        # Plot the resutls
+        fig = plt.figure(figsize=(12, 8))
+        fig.suptitle(f"Processed {spectrograph_type} Spectrogram - {timestamp_str} UTC", fontsize=18)
+        gs = plt.GridSpec(3, 2, width_ratios=[5, 1], height_ratios=[1, 4, 1])
+
+        # Main spectrogram plot
+        ax_main = fig.add_subplot(gs[1, 0])
+        
+        main_image = ax_main.imshow(display_image, cmap='gray', aspect='auto', extent=[wavelengths.min(), wavelengths.max(), 0, rotated_image.shape[0]])
+        tick_positions = np.linspace(fov_start_binned, fov_end_binned, num=7)
+        tick_labels = ["South", "-60", "-30", "Zenith", "30", "60", "North"]
+        ax_main.set_yticks(tick_positions)
+        ax_main.set_yticklabels(tick_labels, fontsize = 14)
+        ax_main.set_xlabel("Wavelength [Å]", fontsize=16)
+        ax_main.set_ylabel("Elevation [Degrees]", fontsize=16)
+        ax_main.grid(False)
+
+        # Spectral analysis subplot using the full wavelength range
+        ax_spectral = fig.add_subplot(gs[0, 0])
+        spectral_line, = ax_spectral.plot(wavelength_range[:len(spectral_avg)], spectral_avg)
+        ax_spectral.set_ylabel("Spectral Radiance [kR/Å]", fontsize=13)
+        ax_spectral.set_title("Spectral Analysis", fontsize=16)
+        ax_spectral.tick_params(axis='both', which= 'major', labelsize = 14)
+        ax_spectral.grid()
+
+        # Spatial analysis subplot with calibration
+        ax_spatial = fig.add_subplot(gs[1, 1])
+        spatial_line, = ax_spatial.plot(spatial_avg, elevation_scale)
+        ax_spatial.set_xlabel("Spatial Radiance [kR/θ]", fontsize=13)
+        ax_spatial.set_title("Spatial Analysis", fontsize=16)
+        ax_spatial.set_yticks(np.linspace(-90, 90, num=9))
+        ax_spatial.set_yticklabels(["South", "-60", "-45", "-30", "Zenith", "30", "45", "60", "North"])
+        ax_spatial.tick_params(axis='both', which= 'major', labelsize = 14)
+        ax_spatial.grid()
+
+        fig.tight_layout()
+        spectrogram_figures[figure_key] = (fig, main_image, spectral_line, spatial_line, ax_spectral, ax_spatial)
+    else:
+        # Reuse the figure, only the data and the autoscaled limits change. The layout of the first spectrogram is kept.
+        fig, main_image, spectral_line, spatial_line, ax_spectral, ax_spatial = spectrogram_figures[figure_key]
+        fig.suptitle(f"Processed {spectrograph_type} Spectrogram - {timestamp_str} UTC", fontsize=18)
+        main_image.set_data(display_image)
+        main_image.autoscale() # Grey scale limits of the new image, as a new imshow would set them.
+        spectral_line.set_ydata(spectral_avg)
+        spatial_line.set_xdata(spatial_avg)
+        for ax in (ax_spectral, ax_spatial):
+            ax.relim()
+            ax.autoscale_view()
 
-    # Plot the resutls
-    fig = plt.figure(figsize=(12, 8))
-    fig.suptitle(f"Processed {spectrograph_type} Spectrogram - {timestamp_str} UTC", fontsize=18)
-    gs = plt.GridSpec(3, 2, width_ratios=[5, 1], height_ratios=[1, 4, 1])
+    #Save the figure, including all subplots
+    fig.savefig(save_path, format='png', dpi=90, bbox_inches='tight', pil_kwargs={'compress_level': compress_level, 'optimize': False})
 
-    # Main spectrogram plot
-    ax_main = fig.add_subplot(gs[1, 0])
-    
-    ax_main.imshow(np.sqrt(np.clip(rotated_image, 0, None)), cmap='gray', aspect='auto', extent=[wavelengths.min(), wavelengths.max(), 0, rotated_image.shape[0]])
-    tick_positions = np.linspace(fov_start_binned, fov_end_binned, num=7)
-    tick_labels = ["South", "-60", "-30", "Zenith", "30", "60", "North"]
-    ax_main.set_yticks(tick_positions)
-    ax_main.set_yticklabels(tick_labels, fontsize = 14)
-    ax_main.set_xlabel("Wavelength [Å]", fontsize=16)
-    ax_main.set_ylabel("Elevation [Degrees]", fontsize=16)
-    ax_main.grid(False)
-
-    # Spectral analysis subplot using the full wavelength range
-    ax_spectral = fig.add_subplot(gs[0, 0])
-    spectral_avg = np.mean(binned_image * k_lambda[np.newaxis, :len(wavelength_range)], axis=0) / 1000 # Convert to kR/Å
-    ax_spectral.plot(wavelength_range[:len(spectral_avg)], spectral_avg)
-    ax_spectral.set_ylabel("Spectral Radiance [kR/Å]", fontsize=13)
-    ax_spectral.set_title("Spectral Analysis", fontsize=16)
-    ax_spectral.tick_params(axis='both', which= 'major', labelsize = 14)
-    ax_spectral.grid()
-
-    # Spatial analysis subplot with calibration
-    ax_spatial = fig.add_subplot(gs[1, 1])
-    spatial_avg = np.mean(rotated_image[fov_start_binned:fov_end_binned,:] * k_lambda[np.newaxis,:], axis=1) / 1000  # Convert to kR/Å
-    spatial_avg_flipped = np.flip(spatial_avg)
-    #elevation_scale = np.linspace(-90, 90, spatial_avg.shape[0])  # Representing the elevation range.
-    elevation_scale =np.linspace(-90, 90, spatial_avg_flipped.shape[0])
-    ax_spatial.plot(spatial_avg, elevation_scale)
-    ax_spatial.set_xlabel("Spatial Radiance [kR/θ]", fontsize=13)
-    ax_spatial.set_title("Spatial Analysis", fontsize=16)
-    ax_spatial.set_yticks(np.linspace(-90, 90, num=9))
-    ax_spatial.set_yticklabels(["South", "-60", "-45", "-30", "Zenith", "30", "45", "60", "North"])
-    ax_spatial.tick_params(axis='both', which= 'major', labelsize = 14)
-    ax_spatial.grid()
-
-    plt.tight_layout()
+# Process and save a single spectrogram, job is (image_path, spectrograph_type, timestamp_str, save_path). Runs in the worker processes of process_last_5_minute_spectrograms.
+def process_spectrogram(job):
+    image_path, spectrograph_type, timestamp_str, save_path = job
+    print(f"Processing image: {image_path}")
+    image_array = load_png(image_path)
 
-    #Save the figure, including all subplots
-    plt.savefig(save_path, format='png', bbox_inches='tight')
-    plt.close(fig)
+    # Process and save the figure
+    process_and_plot_with_flip_and_rotate(image_array, spectrograph_type, save_path, timestamp_str)
+    print(f"Processed and saved spectrogram: {save_path}")
+    return save_path
 
-# Function to process the averaged spectrograms of the last 5minutes.
-def process_last_5_minute_spectrograms(averaged_PNG_folder, processed_spectrogram_dir):
+# Function to process the averaged spectrograms of the last 5minutes. The spectrograms are independent, so they are spread over the executor's worker processes when one is given.
+def process_last_5_minute_spectrograms(averaged_PNG_folder, processed_spectrogram_dir, executor=None):
     now = datetime.now(timezone.utc) # Current UTC time.
     five_minutes_ago = now - timedelta(minutes=5)
+    five_minutes_ago_timestamp = five_minutes_ago.timestamp()
+    # The filename timestamps are compared as YYYYMMDDHHMMSS integers, no datetime is parsed per file
+    five_minutes_ago_key, now_key = int(five_minutes_ago.strftime('%Y%m%d%H%M%S')), int(now.strftime('%Y%m%d%H%M%S'))
     last_processed_path = None  # Tracking the last processed spectrogram to put in on the website.
-
-    # Walk through the directory 
-    for root, _, files in os.walk(averaged_PNG_folder):
-        for file in files:
-            if file.endswith('.png'):
-                match = re.search(r'(\d{8})-(\d{6})\.png', file)
-                if match:
-                    date_str = match.group(1)
-                    time_str = match.group(2)
-                    timestamp_str = f"{date_str}-{time_str}"
-                    timestamp = datetime.strptime(timestamp_str, '%Y%m%d-%H%M%S').replace(tzinfo=timezone.utc)
-
-                    if five_minutes_ago <= timestamp <= now:
-                        image_path = os.path.join(root, file)
-                        print(f"Processing image: {image_path}")
-                        image_array = np.array(Image.open(image_path))
-
-                        if "MISS1" in file:
-                            spectrograph_type = "MISS1"
-                        elif "MISS2" in file:
-                            spectrograph_type = "MISS2"
-                        else:
-                            print("Spectrograph type not identified.")
-                            continue
-
-                        # Create folder structure and save path
-                        date_folder = os.path.join(processed_spectrogram_dir, date_str[:4], date_str[4:6], date_str[6:8])
-                        os.makedirs(date_folder, exist_ok=True)
-                        processed_image_name = f"{spectrograph_type}-ProcessedSpectrogram-{timestamp_str}.png"
-                        save_path = os.path.join(date_folder, processed_image_name)
-
-                        # Process and save the figure
-                        process_and_plot_with_flip_and_rotate(image_array, spectrograph_type, save_path, timestamp_str)
-                        print(f"Processed and saved spectrogram: {save_path}")
-
-                        last_processed_path = save_path # Tracking the last processed spectrogram
+    jobs = []
+
+    # Only the day folders of the last five minutes can hold new spectrograms (two around midnight), the older days are not walked.
+    day_folders = sorted({os.path.join(averaged_PNG_folder, moment.strftime("%Y/%m/%d")) for moment in (five_minutes_ago, now)})
+    for day_folder in day_folders:
+        if not os.path.isdir(day_folder):
+            continue
+
+        # Finding the PNG files modified within the last 5 minutes before any filename parsing, scandir gives the modification time without an extra stat call per file on most platforms.
+        with os.scandir(day_folder) as directory_entries:
+            recent_entries = sorted((entry for entry in directory_entries if entry.name.endswith('.png') and entry.stat().st_mtime >= five_minutes_ago_timestamp), key=lambda entry: entry.name)
+
+        for entry in recent_entries: # Sorted by name, so the last processed spectrogram is the latest one
+            file = entry.name
+            match = re.search(r'(\d{8})-(\d{6})\.png', file)
+            if not match:
+                continue
+            date_str = match.group(1)
+            time_str = match.group(2)
+            timestamp_str = f"{date_str}-{time_str}"
+
+            if five_minutes_ago_key <= int(date_str + time_str) <= now_key:
+                # The averaged spectrograms are named {device_name}-YYYYMMDD-HHMMSS.png, so the spectrograph is the prefix
+                if file.startswith("MISS1"):
+                    spectrograph_type = "MISS1"
+                elif file.startswith("MISS2"):
+                    spectrograph_type = "MISS2"
+                else:
+                    print("Spectrograph type not identified.")
+                    continue
+
+                # Create folder structure and save path
+                date_folder = os.path.join(processed_spectrogram_dir, date_str[:4], date_str[4:6], date_str[6:8])
+                os.makedirs(date_folder, exist_ok=True)
+                processed_image_name = f"{spectrograph_type}-ProcessedSpectrogram-{timestamp_str}.png"
+                save_path = os.path.join(date_folder, processed_image_name)
+                jobs.append((entry.path, spectrograph_type, timestamp_str, save_path))
+
+    # map keeps the order of the jobs, so the last processed spectrogram is still the latest one
+    for save_path in (executor.map(process_spectrogram, jobs) if executor else map(process_spectrogram, jobs)):
+        last_processed_path = save_path # Tracking the last processed spectrogram
 
     if last_processed_path:  # Saving the last processed spectrogram and putting it on the website.
         lastest_spectrogram_save_path = os.path.join("Z:\\kho\\MISS2", "latest-spectrogram.png")
         print(f"Saving the last processed spectrogram to:{lastest_spectrogram_save_path}")
-        Image.open(last_processed_path).save(lastest_spectrogram_save_path)
-
-# Call the function to process the last 5-minute averaged spectrograms
-process_last_5_minute_spectrograms(averaged_PNG_folder, processed_spectrogram_dir)
+        # Byte copy of the saved PNG to a temporary name next to it, then swapped in with a rename so the website never serves a half-written file
+        temporary_save_path = lastest_spectrogram_save_path + ".tmp"
+        shutil.copyfile(last_processed_path, temporary_save_path)
+        os.replace(temporary_save_path, lastest_spectrogram_save_path)
+
+if __name__ == "__main__":
+    # Worker processes rather than threads since matplotlib is not thread-safe. The pool lives for the whole run, so each worker keeps its figures between runs.
+    with ProcessPoolExecutor(max_workers=max(1, (os.cpu_count() or 2) // 2)) as executor:
+        # Keep running and process the last 5-minute averaged spectrograms every 300 seconds, instead of being restarted for every run.
+        while True:
+            start_time = time.time()
+            process_last_5_minute_spectrograms(averaged_PNG_folder, processed_spectrogram_dir, executor)
+            time.sleep(max(300 - (time.time() - start_time), 0)) # Sleep for 300 seconds minus processing time
 
@@ -45,4 +45,8 @@ parameters = {
     # Add num_pixels_y and num_minutes to parameters.py
     'num_pixels_y': 300,  # Number of pixels along the y-axis (for RGB with 300 rows)
     'num_minutes': 24 * 60,  # Total number of minutes in a day
+
+    # Spectrogram processing
+    'compress_level': 1,  # zlib level (0-9) of the live processed spectrogram PNGs, higher gives smaller files for more CPU time
+    'log_level': 'WARNING',  # Logging level of the live spectrogram processor, 'DEBUG' shows the calibration and image shape debugging output
 }
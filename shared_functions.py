@@ -0,0 +1,85 @@
+'''
+Helper functions shared by several MISS scripts (capture, averaging and RGB column making), kept in this one place next to parameters.py so the scripts cannot drift apart.
+'''
+
+import os
+import json
+import numpy as np
+from PIL import Image
+from parameters import parameters  # Import parameters from parameters.py
+
+num_pixels_y = parameters['num_pixels_y']
+num_minutes = parameters['num_minutes']
+
+# Function to wrap a uint16 array as a 16bit PIL image without copying it, Image.fromarray checks the byte order and copies the data.
+def uint16_array_to_image(img_array):
+    img_array = np.ascontiguousarray(img_array, dtype='<u2')
+    return Image.frombuffer('I;16', (img_array.shape[1], img_array.shape[0]), img_array, 'raw', 'I;16', 0, 1)
+
+# Function to average a list of 16bit images. They are summed one by one into a single uint32 accumulator, which is exact for any realistic number of images per minute and avoids float conversion.
+def average_uint16_images(img_arrays):
+    if len(img_arrays) == 1: # A single image is its own average, nothing to sum.
+        return img_arrays[0]
+    accumulator = np.zeros(img_arrays[0].shape, dtype=np.uint32)
+    for img_array in img_arrays:
+        np.add(accumulator, img_array, out=accumulator, casting='unsafe')
+    np.floor_divide(accumulator, len(img_arrays), out=accumulator)
+    return accumulator.astype(np.uint16)
+
+# Functions to load and save the minute keys that are already averaged, so a rerun skips them. A missing or unreadable file means nothing is processed yet.
+def load_processed_minutes(processed_minutes_path):
+    try:
+        with open(processed_minutes_path) as f:
+            return set(json.load(f))
+    except (OSError, ValueError):
+        return set()
+
+def save_processed_minutes(processed_minutes_path, processed_minutes):
+    try:
+        os.makedirs(os.path.dirname(processed_minutes_path), exist_ok=True)
+        with open(processed_minutes_path, 'w') as f:
+            json.dump(sorted(processed_minutes), f)
+    except OSError as e:
+        print(f"Error saving processed minutes: {e}")
+
+# Average the rows of a strip (or a stack of strips) along the row axis, leaving out the lowest and highest value of each column to reject spikes.
+def trimmed_row_mean(strips):
+    strips = strips.astype(np.float32)
+    num_rows = strips.shape[-2]
+    if num_rows <= 2:
+        return strips.mean(axis=-2) # Nothing left to average after trimming
+    row_sum = strips.sum(axis=-2)
+    row_sum -= strips.max(axis=-2)
+    row_sum -= strips.min(axis=-2)
+    row_sum /= num_rows - 2
+    return row_sum
+
+# Write an RGB column into the raw daily file of shape (num_minutes, num_pixels_y, 3) uint8, kept next to the PNG columns so the keogram can be built with a single read.
+# The raw file is only a cache: if it cannot be written the column is still saved as PNG, and the keogram maker reads the minutes missing from the raw file from the PNG columns.
+def write_rgb_column_to_raw_file(output_folder, filename_without_ext, rgb_column):
+    date_part, time_part = filename_without_ext[-15:-7], filename_without_ext[-6:] # Filenames end with YYYYMMDD-HHMMSS.
+    minute = int(time_part[:2]) * 60 + int(time_part[2:4])
+    raw_path = os.path.join(output_folder, f"keogram_raw_{date_part}.bin")
+    try:
+        if not os.path.exists(raw_path):
+            # The file is filled under a temporary name and linked into place, so the keogram maker never sees a partly written file.
+            # Linking fails if the other RGB column maker created the file first, its columns are then kept instead of being truncated.
+            temporary_path = f"{raw_path}.{os.getpid()}.tmp"
+            try:
+                with open(temporary_path, 'wb') as f:
+                    f.write(b'\xff' * (num_minutes * num_pixels_y * 3)) # Minutes without a column stay white, as in the keogram.
+                os.link(temporary_path, raw_path)
+            except FileExistsError:
+                pass
+            finally:
+                if os.path.exists(temporary_path):
+                    os.remove(temporary_path)
+        if os.path.getsize(raw_path) != num_minutes * num_pixels_y * 3:
+            # Mapping a short file would extend it with black columns, it is left as is and the keogram maker skips it.
+            print(f"Unexpected size of {raw_path}, the keogram will use the PNG column instead.")
+            return
+        raw_columns = np.memmap(raw_path, dtype=np.uint8, mode='r+', shape=(num_minutes, num_pixels_y, 3))
+        raw_columns[minute] = rgb_column.reshape(num_pixels_y, 3)
+        raw_columns.flush()
+    except OSError as e:
+        print(f"Could not write the column to {raw_path}, the keogram will use the PNG column instead: {e}")